@@ -0,0 +1,86 @@
+"""
+Import time benchmark
+
+Runs every scenario in fresh interpreters, prints the best time of several runs and checks
+that heavy modules are not imported by scenarios that do not need them.
+Exit code is 1 if a heavy module is imported or a scenario is slower than --max seconds.
+
+python benchmarks/import_time.py [--repeat N] [--max SECONDS]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# child interpreters run in the root of repository, so they import prac_code from it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["sympy", "matplotlib", "scipy.optimize", "scipy.stats", "scipy.odr", "tkinter"]
+
+# (name, code, modules that are allowed to be imported)
+SCENARIOS = [
+    ("import prac_code", "import prac_code", []),
+    (
+        "Value propagation",
+        "from prac_code import Value\n"
+        "a = Value(2.0, 0.1)\n"
+        "b = Value(values=[3.0], syst=0.2)\n"
+        "str(a * b + a ** 2 / b)",
+        []
+    ),
+    (
+        "ValueArray propagation",
+        "import numpy as np\n"
+        "from prac_code import ValueArray\n"
+        "x = ValueArray(np.arange(1.0, 100.0), 0.1)\n"
+        "(x * x + np.sqrt(x)).sum().errors",
+        []
+    ),
+    ("Plotter", "from prac_code import Plotter", []),
+    ("print_value_error", "from prac_code import Value\nValue(2.0, 0.1).print_value_error()", ["sympy"]),
+]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+exec(compile({code!r}, "<scenario>", "exec"))
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(m for m in {heavy!r} if m in sys.modules)]))
+"""
+
+
+def run(code):
+    """:return (time in seconds, list of heavy modules imported) of code in fresh interpreter"""
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(code=code, heavy=HEAVY_MODULES)],
+        check=True, capture_output=True, text=True, cwd=ROOT
+    ).stdout
+    elapsed, modules = json.loads(out.strip().splitlines()[-1])
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max", type=float, default=None, help="maximal time of every scenario in seconds")
+    args = parser.parse_args()
+
+    failed = False
+    for name, code, allowed in SCENARIOS:
+        results = [run(code) for _ in range(args.repeat)]
+        best = min(elapsed for elapsed, _ in results)
+        modules = sorted(set(m for _, ms in results for m in ms) - set(allowed))
+        status = "ok"
+        if modules:
+            status = "imports " + ", ".join(modules)
+            failed = True
+        elif args.max is not None and best > args.max:
+            status = "slower than {:.3f} s".format(args.max)
+            failed = True
+        print("{:<24} {:8.1f} ms  {}".format(name, best * 1000, status))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
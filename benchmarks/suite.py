@@ -0,0 +1,307 @@
+"""
+Benchmark suite
+
+Measures time and peak memory of Value arithmetic, error extraction, fitting, plotting and tables
+on synthetic datasets from 10 to 1M points. Results are compared with baseline.json next to this file,
+cases that are slower than baseline by more than --threshold times are reported as regressions.
+Times are compared in units of calibration loop that is measured on every run, so baseline that is saved
+on one machine can be used on others, it can be saved again with --save for more precise comparison.
+
+python benchmarks/suite.py [--filter NAME] [--max-size N] [--save] [--threshold 1.5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MIN_TIME = 0.2
+BENCHMARKS = []
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(sizes):
+    """Registers function that takes size and returns function to measure"""
+    def decorator(setup):
+        BENCHMARKS.append((setup.__name__, sizes, setup))
+        return setup
+    return decorator
+
+
+def get_data(size, seed=0):
+    """:return (x, y, sigma_y) synthetic straight line with noise"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(1.0, 100.0, size)
+    sigma = np.full(size, 0.5)
+    return x, 3.0 * x + 2.0 + rng.normal(0.0, 0.5, size), sigma
+
+
+@benchmark([10, 1000, 100000])
+def value_construction(size):
+    from prac_code.value import Value
+    values = np.random.default_rng(0).uniform(1.0, 2.0, size).tolist()
+    return lambda: [Value(v, 0.1) for v in values]
+
+
+@benchmark([10, 1000, 100000])
+def value_repeated_construction(size):
+    from prac_code.value import Value
+    repeats = np.random.default_rng(0).normal(1.0, 0.1, (size, 5)).tolist()
+    return lambda: [Value(values=r, syst=0.01) for r in repeats]
+
+
+@benchmark([10, 1000, 100000])
+def operator_chain(size):
+    from prac_code.value import Value
+    values = [Value(1.0 + i * 1e-6, 0.01) for i in range(size)]
+
+    def run():
+        res = values[0]
+        for v in values[1:]:
+            res = res * 1.000001 + v / 3.0
+        return res.get_value_error()
+    return run
+
+
+@benchmark([10, 1000, 100000])
+def get_value_error(size):
+    from prac_code.value import Value
+    a = [Value(float(i + 1), 0.1) for i in range(size)]
+    b = [Value(float(i + 2), 0.2) for i in range(size)]
+
+    def run():
+        return [(x * y + x ** 2 / y).get_value_error() for x, y in zip(a, b)]
+    return run
+
+
+@benchmark([10, 100])
+def print_value_error(size):
+    from prac_code.value import Value
+    values = [Value(float(i + 1), 0.1) for i in range(size)]
+
+    def run():
+        res = values[0]
+        for v in values[1:]:
+            res = res + v * v
+        return res.print_value_error()
+    return run
+
+
+@benchmark([10, 1000, 100000, 1000000])
+def value_array_arithmetic(size):
+    from prac_code.value import Value, ValueArray
+    x = ValueArray(np.linspace(1.0, 2.0, size), 0.01)
+    shared = Value(0.0, 0.1)
+
+    def run():
+        res = (x * 2.0 + shared) / np.sqrt(x)
+        return res.get_value_error()
+    return run
+
+
+def _extraction(size, pool):
+    from prac_code.plotter import Plotter
+    from prac_code.value import Value
+    values = [Value(float(v), 0.1) for v in np.linspace(1.0, 2.0, size)]
+    if pool:
+        Plotter.start_executor()
+        Plotter.get_value_error_arrays(values[:1])
+    else:
+        Plotter.stop_executor()
+
+    def run():
+        old = Plotter.PARALLEL_SIZE
+        Plotter.PARALLEL_SIZE = 0 if pool else old
+        try:
+            return Plotter.get_value_error_arrays(values)
+        finally:
+            Plotter.PARALLEL_SIZE = old
+    return run
+
+
+@benchmark([10, 1000, 100000])
+def extraction_without_pool(size):
+    return _extraction(size, False)
+
+
+@benchmark([10, 1000, 100000])
+def extraction_with_pool(size):
+    return _extraction(size, True)
+
+
+@benchmark([10, 1000, 100000, 1000000])
+def extraction_value_array(size):
+    from prac_code.plotter import Plotter
+    from prac_code.value import ValueArray
+    values = ValueArray(np.linspace(1.0, 2.0, size), 0.1)
+    return lambda: Plotter.get_value_error_arrays(values)
+
+
+@benchmark([10, 1000, 100000, 1000000])
+def linear_fit(size):
+    from prac_code.fitting import linear_fit as fit
+    x, y, sigma = get_data(size)
+    return lambda: fit(x, y, sigma)
+
+
+@benchmark([10, 1000, 100000, 1000000])
+def nonlinear_fit(size):
+    from prac_code.plotter import Plotter
+    x, y, sigma = get_data(size)
+    line = Plotter.get_new_line(
+        x_value=None, y_value=None, color="k", marker="o", draw_error=False, fit=True, legend=None,
+        func=_quadratic, p0=[0.0, 3.0, 2.0]
+    )
+    return lambda: Plotter.fit_line(line, x, y, np.zeros(size), sigma)
+
+
+def _quadratic(x, a, b, c):
+    return a * x ** 2 + b * x + c
+
+
+@benchmark([10, 1000, 100000])
+def plotting(size):
+    from prac_code.plotter import Plotter
+    from prac_code.value import ValueArray
+    x, y, sigma = get_data(size)
+    line = Plotter.get_new_line(
+        x_value=ValueArray(x, 0.1), y_value=ValueArray(y, sigma), color="k", marker="o",
+        draw_error=True, fit=True, legend="data"
+    )
+    plotter = Plotter(lines=[line], name="benchmark")
+    directory = tempfile.mkdtemp()
+    return lambda: plotter.render(directory=directory)
+
+
+def _cells(size):
+    """:return 2d array of cells of tables.Table with header and size rows of numbers"""
+    rows = [["{:.3f}".format(v) for v in row] for row in np.random.default_rng(0).uniform(0, 10, (size, 5))]
+    return np.array([["t", "x", "y", "z", "w"]] + rows, dtype=object)
+
+
+def _table_write(size, extension):
+    from prac_code.tableio import write_cells
+    cells = _cells(size)
+    path = os.path.join(tempfile.mkdtemp(), "table" + extension)
+    return lambda: write_cells(path, cells)
+
+
+def _table_read(size, extension):
+    from prac_code.tableio import write_cells, read_cells
+    path = os.path.join(tempfile.mkdtemp(), "table" + extension)
+    write_cells(path, _cells(size))
+    return lambda: read_cells(path)
+
+
+@benchmark([10, 1000, 100000])
+def table_write_tab(size):
+    return _table_write(size, ".tab")
+
+
+@benchmark([10, 1000, 100000])
+def table_read_tab(size):
+    return _table_read(size, ".tab")
+
+
+@benchmark([10, 1000, 100000])
+def table_write_npz(size):
+    return _table_write(size, ".npz")
+
+
+@benchmark([10, 1000, 100000])
+def table_read_npz(size):
+    return _table_read(size, ".npz")
+
+
+def calibration_loop():
+    """Fixed amount of python and numpy work, times of cases are compared in units of its time"""
+    x = np.linspace(1.0, 2.0, 10000)
+    res = 0.0
+    for v in x.tolist():
+        res += v * v
+    return res + float(np.sqrt(x).sum())
+
+
+def measure(func):
+    """:return (best time of one call in seconds, number of calls, peak memory of one call in bytes)"""
+    times = []
+    start = time.perf_counter()
+    while not times or (time.perf_counter() - start < MIN_TIME and len(times) < 1000):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), len(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="run only benchmarks with this substring in name")
+    parser.add_argument("--max-size", type=int, default=1000000)
+    parser.add_argument("--save", action="store_true", help="store results as new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown that is reported as regression")
+    args = parser.parse_args()
+
+    baseline = {"calibration": None, "cases": {}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    # freed large block raises dynamic mmap threshold of allocator, so the state of allocator
+    # does not depend on cases that were run before
+    np.ones(1 << 21)
+    calibration = measure(calibration_loop)[0]
+    results = dict(baseline["cases"]) if args.save else {}
+    regressions = []
+    print("calibration loop: {:.3f} ms".format(calibration * 1000))
+    print("{:<32} {:>12} {:>8} {:>12} {:>9}".format("case", "time, ms", "calls", "memory, KiB", "baseline"))
+    for name, sizes, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        try:
+            # the smallest case loads lazy imports and caches, so they are not measured
+            setup(sizes[0])()
+        except Skip:
+            pass
+        for size in sizes:
+            if size > args.max_size:
+                continue
+            case = "{}[{}]".format(name, size)
+            try:
+                best, calls, peak = measure(setup(size))
+            except Skip as e:
+                print("{:<32} skipped: {}".format(case, e))
+                continue
+            ratio = ""
+            if case in baseline["cases"]:
+                ratio = best / calibration / baseline["cases"][case]["relative"]
+                if ratio > args.threshold:
+                    regressions.append(case)
+                ratio = "{:.2f}x".format(ratio)
+            results[case] = {"time": best, "relative": best / calibration, "memory": peak}
+            print("{:<32} {:12.3f} {:8d} {:12.1f} {:>9}".format(case, best * 1000, calls, peak / 1024, ratio))
+
+    from prac_code.plotter import Plotter
+    Plotter.stop_executor()
+    if args.save:
+        with open(BASELINE, "w") as file:
+            json.dump({"calibration": calibration, "cases": results}, file, indent=1, sort_keys=True)
+    if regressions:
+        print("regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,30 @@
-from prac_code.plotter import Plotter
-from prac_code.value import Value
-from prac_code.tables import start
+__version__ = '0.1'
+
+# names are imported from their modules on first access, so importing prac_code does not load
+# matplotlib, sympy, scipy or tkinter until they are needed
+_LAZY_ATTRIBUTES = {
+    'Plotter': 'prac_code.plotter',
+    'Profiler': 'prac_code.profiling',
+    'profile': 'prac_code.profiling',
+    'Value': 'prac_code.value',
+    'ValueArray': 'prac_code.value',
+    'start': 'prac_code.tables',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        from importlib import import_module
+        res = getattr(import_module(_LAZY_ATTRIBUTES[name]), name)
+        globals()[name] = res
+        return res
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
 
 
 def main():
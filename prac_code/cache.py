@@ -0,0 +1,420 @@
+"""
+Cache module
+
+Contains class Cache that stores results of computations (Values, ValueArrays, arrays, fit results)
+on disk in .npz files. Results are addressed by hash of inputs, formula structure and library version,
+so unchanged stages of notebook are loaded instead of recomputed.
+"""
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
+from hashlib import sha256
+from importlib import import_module
+import json
+import os
+import sys
+import time
+from types import BuiltinFunctionType, ClassMethodDescriptorType, GetSetDescriptorType, MemberDescriptorType, \
+    MethodDescriptorType, MethodType, ModuleType, WrapperDescriptorType
+
+import numpy as np
+from scipy import sparse
+
+import prac_code
+from prac_code.value import Value, ValueArray
+from prac_code.profiling import stage
+
+
+# attributes of classes that do not change their behaviour
+_SKIPPED_ATTRIBUTES = {
+    '__dict__', '__weakref__', '__module__', '__qualname__', '__doc__', '__slots__', '_abc_impl',
+    '__dataclass_fields__', '__dataclass_params__'
+}
+# attributes of compiled classes and fields of namedtuples, they are fixed by their library
+_COMPILED_ATTRIBUTES = (
+    BuiltinFunctionType, ClassMethodDescriptorType, GetSetDescriptorType, MemberDescriptorType,
+    MethodDescriptorType, WrapperDescriptorType, type(namedtuple('_Pair', 'first').first)
+)
+
+
+class _Context:
+    """State of hashing of one key: canonical numbers of error sources and ids of objects that are being hashed"""
+
+    def __init__(self):
+        self.sources = {}
+        self.visited = set()
+
+    def number(self, source):
+        """:return number of error source in order of first appearance in key"""
+        return self.sources.setdefault(source, len(self.sources))
+
+
+def _hash_code(h, code, namespace, context):
+    """Updates h by code and content of globals it uses, namespace is dict of globals of function"""
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for name in code.co_names:
+        if name in namespace:
+            h.update(name.encode())
+            _hash(h, namespace[name], context)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(h, const, namespace, context)
+        else:
+            h.update(repr(const).encode())
+
+
+def _hash_qualname(h, obj):
+    h.update((str(getattr(obj, '__module__', '')) + '.' + obj.__qualname__).encode())
+
+
+def _hash_class(h, cls, context):
+    """
+    Updates h by qualname of class and content of attributes of it and its bases,
+    builtin classes and classes of prac_code are hashed by qualname, version of library is a part of key
+    """
+    _hash_qualname(h, cls)
+    if cls.__module__ == 'builtins' or cls.__module__.split('.')[0] == 'prac_code' or id(cls) in context.visited:
+        return
+    context.visited.add(id(cls))
+    for base in cls.__mro__:
+        if base.__module__ == 'builtins':
+            continue
+        attributes = vars(base)
+        for name in sorted(attributes):
+            attr = attributes[name]
+            if name in _SKIPPED_ATTRIBUTES or isinstance(attr, _COMPILED_ATTRIBUTES):
+                continue
+            if isinstance(attr, (staticmethod, classmethod)):
+                attr = attr.__func__
+            elif isinstance(attr, property):
+                attr = (attr.fget, attr.fset, attr.fdel)
+            h.update(name.encode())
+            _hash(h, attr, context)
+
+
+def _hash_instance(h, obj, context):
+    """Updates h by class and attributes of instance, TypeError is raised if they are not accessible"""
+    cls = type(obj)
+    _hash_class(h, cls, context)
+    if id(obj) in context.visited:
+        return
+    context.visited.add(id(obj))
+    state = dict(vars(obj)) if hasattr(obj, '__dict__') else {}
+    has_slots = False
+    for base in cls.__mro__:
+        slots = base.__dict__.get('__slots__', ())
+        for name in [slots] if isinstance(slots, str) else slots:
+            if name in ('__dict__', '__weakref__'):
+                continue
+            has_slots = True
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_' + base.__name__.lstrip('_') + name
+            if hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    if not hasattr(obj, '__dict__') and not has_slots:
+        raise TypeError("{} can not be hashed by content".format(cls.__name__))
+    _hash(h, state, context)
+
+
+def _hash(h, obj, context):
+    """
+    Updates hash object h by content of obj, TypeError is raised if obj is not hashable by content.
+    Error sources of Values and ValueArrays are hashed by their numbers in context, so keys of arguments
+    with shared sources differ from keys of arguments with independent ones
+    """
+    # sympy expressions can exist only if sympy is imported already
+    sympy = sys.modules.get('sympy')
+    h.update(type(obj).__name__.encode())
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            for x in obj.ravel():
+                _hash(h, x, context)
+        else:
+            h.update(str(obj.dtype).encode())
+            h.update(repr(obj.shape).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, ValueArray):
+        values, jacobian, sigma = _value_array_parts(obj)
+        for arr in (values, jacobian.data, jacobian.indices, jacobian.indptr, sigma):
+            _hash(h, arr, context)
+        _hash(h, [context.number(key) for key, _ in obj.sources], context)
+    elif isinstance(obj, Value):
+        val, grad = obj.get_gradient()
+        _hash(h, float(val), context)
+        _hash(h, sorted(
+            (context.number(leaf), float(d), float(sigma)) for leaf, (d, sigma) in grad.items()
+        ), context)
+    elif sympy is not None and isinstance(obj, sympy.Basic):
+        h.update(sympy.srepr(obj).encode())
+    elif isinstance(obj, ModuleType):
+        h.update(obj.__name__.encode())
+    elif isinstance(obj, partial):
+        _hash(h, (obj.func, obj.args, obj.keywords), context)
+    elif isinstance(obj, MethodType):
+        _hash(h, obj.__func__, context)
+        _hash_bound(h, obj.__self__, context)
+    elif isinstance(obj, type):
+        _hash_class(h, obj, context)
+    elif hasattr(obj, '__code__'):
+        if id(obj) in context.visited:
+            # recursive functions are hashed once
+            _hash_qualname(h, obj)
+            return
+        context.visited.add(id(obj))
+        _hash_code(h, obj.__code__, getattr(obj, '__globals__', {}), context)
+        _hash(h, obj.__defaults__, context)
+        _hash(h, tuple(cell.cell_contents for cell in obj.__closure__ or ()), context)
+    elif isinstance(obj, BuiltinFunctionType):
+        _hash_qualname(h, obj)
+        if obj.__self__ is not None and not isinstance(obj.__self__, ModuleType):
+            _hash_bound(h, obj.__self__, context)
+    elif isinstance(obj, np.ufunc):
+        h.update(obj.__name__.encode())
+    elif callable(obj):
+        _hash_instance(h, obj, context)
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for x in obj:
+            _hash(h, x, context)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(str(len(obj)).encode())
+        for x in sorted(obj, key=repr):
+            _hash(h, x, context)
+    elif isinstance(obj, dict):
+        h.update(str(len(obj)).encode())
+        for key in sorted(obj, key=repr):
+            _hash(h, key, context)
+            _hash(h, obj[key], context)
+    else:
+        raise TypeError("{} can not be hashed by content".format(type(obj).__name__))
+
+
+def _hash_bound(h, obj, context):
+    """Updates h by object that method is bound to, instances of other classes are hashed by their attributes"""
+    if obj is None or isinstance(obj, (
+        bool, int, float, complex, str, bytes, np.generic, np.ndarray, ValueArray, Value,
+        type, ModuleType, list, tuple, set, frozenset, dict
+    )):
+        _hash(h, obj, context)
+    else:
+        _hash_instance(h, obj, context)
+
+
+def _value_array_parts(value_array):
+    """:return (values, jacobian, sigma) of ValueArray, sigma are errors of its sources"""
+    values, _ = value_array.get_value_error()
+    jacobian = sparse.csr_matrix(value_array.jacobian)
+    sources = value_array.sources
+    sigma = np.concatenate([s for _, s in sources]) if sources else np.zeros(0)
+    return values, jacobian, sigma
+
+
+def _encode(obj, arrays):
+    """:return json description of obj, arrays are added to dict arrays"""
+    def array(arr):
+        name = "a{}".format(len(arrays))
+        arrays[name] = np.asarray(arr)
+        return name
+
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return {"t": "py", "v": obj}
+    if isinstance(obj, np.generic):
+        return {"t": "array", "k": array(obj), "scalar": True}
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("arrays of objects can not be cached")
+        return {"t": "array", "k": array(obj), "scalar": False}
+    if isinstance(obj, ValueArray):
+        values, jacobian, sigma = _value_array_parts(obj)
+        sizes = [s.size for _, s in obj.sources]
+        return {
+            "t": "value_array", "values": array(values), "data": array(jacobian.data),
+            "indices": array(jacobian.indices), "indptr": array(jacobian.indptr),
+            "columns": jacobian.shape[1], "sigma": array(sigma), "sizes": sizes
+        }
+    if isinstance(obj, Value):
+        val, er = obj.get_value_error(rounded=False)
+        return {"t": "value", "v": val, "e": er}
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return {
+            "t": "namedtuple", "module": type(obj).__module__, "name": type(obj).__qualname__,
+            "items": [_encode(x, arrays) for x in obj]
+        }
+    if isinstance(obj, (list, tuple)):
+        return {"t": type(obj).__name__, "items": [_encode(x, arrays) for x in obj]}
+    if isinstance(obj, dict):
+        return {
+            "t": "dict",
+            "keys": [_encode(x, arrays) for x in obj],
+            "items": [_encode(x, arrays) for x in obj.values()]
+        }
+    raise TypeError("{} can not be cached".format(type(obj).__name__))
+
+
+def _decode(desc, arrays):
+    """:return object described by json description and arrays"""
+    kind = desc["t"]
+    if kind == "py":
+        return desc["v"]
+    if kind == "array":
+        arr = arrays[desc["k"]]
+        return arr[()] if desc["scalar"] else arr
+    if kind == "value_array":
+        values = arrays[desc["values"]]
+        jacobian = sparse.csr_matrix(
+            (arrays[desc["data"]], arrays[desc["indices"]], arrays[desc["indptr"]]),
+            shape=(values.size, desc["columns"])
+        )
+        sigma = np.split(arrays[desc["sigma"]], np.cumsum(desc["sizes"])[:-1]) if desc["sizes"] else []
+        return ValueArray(values=values, jacobian=jacobian, sources=tuple((object(), s) for s in sigma))
+    if kind == "value":
+        return Value(desc["v"], desc["e"])
+    if kind == "namedtuple":
+        cls = import_module(desc["module"])
+        for name in desc["name"].split('.'):
+            cls = getattr(cls, name)
+        return cls(*[_decode(x, arrays) for x in desc["items"]])
+    if kind in ("list", "tuple"):
+        items = [_decode(x, arrays) for x in desc["items"]]
+        return items if kind == "list" else tuple(items)
+    if kind == "dict":
+        return dict(zip([_decode(x, arrays) for x in desc["keys"]], [_decode(x, arrays) for x in desc["items"]]))
+    raise ValueError("unknown cached type {}".format(kind))
+
+
+class Cache:
+    """
+    Cache class
+
+    Content-addressed cache on disk. Every result is stored in its own .npz file and index.json keeps
+    their sizes and last access times, least recently used results are removed when total size exceeds max_size.
+    Values and ValueArrays are restored with the same values and errors and ValueArrays keep correlations
+    between their elements, but restored error sources are new, so they are not correlated with other objects.
+    """
+
+    MAX_SIZE = 1 << 28
+    INDEX = "index.json"
+
+    def __init__(self, directory, **kwargs):
+        """
+        :param directory: directory of cache, it is created if it does not exist
+        :param kwargs: max_size -- maximal total size of files in bytes (Cache.MAX_SIZE by default)
+        """
+        self.__directory = directory
+        self.__max_size = kwargs['max_size'] if 'max_size' in kwargs else Cache.MAX_SIZE
+        os.makedirs(directory, exist_ok=True)
+        self.__index = self.__read_index()
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @staticmethod
+    def get_key(*args, **kwargs):
+        """
+        :return hex key of args and kwargs that depends on their content and version of library,
+        functions are hashed by their code and content of globals they use, bound methods and callable objects
+        are hashed with content of their instances, classes with content of their attributes,
+        TypeError is raised if some of them can not be hashed by content
+        """
+        h = sha256(prac_code.__version__.encode())
+        context = _Context()
+        _hash(h, args, context)
+        _hash(h, kwargs, context)
+        return h.hexdigest()
+
+    def __read_index(self):
+        try:
+            with open(os.path.join(self.__directory, Cache.INDEX), 'r') as file:
+                return OrderedDict(sorted(json.load(file).items(), key=lambda item: item[1]["time"]))
+        except (OSError, ValueError):
+            return OrderedDict()
+
+    def __write_index(self):
+        path = os.path.join(self.__directory, Cache.INDEX)
+        with open(path + ".tmp", 'w') as file:
+            json.dump(self.__index, file)
+        os.replace(path + ".tmp", path)
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key + ".npz")
+
+    def __contains__(self, key):
+        return key in self.__index and os.path.exists(self.__path(key))
+
+    def get_size(self):
+        """:return total size of cached files in bytes"""
+        return sum(entry["size"] for entry in self.__index.values())
+
+    @stage("cache.load")
+    def load(self, key):
+        """:return cached object, KeyError is raised if there is no such key"""
+        if key not in self:
+            raise KeyError(key)
+        with np.load(self.__path(key), allow_pickle=False) as data:
+            arrays = dict(data.items())
+        res = _decode(json.loads(str(arrays.pop("__structure__"))), arrays)
+        self.__index[key]["time"] = time.time()
+        self.__index.move_to_end(key)
+        self.__write_index()
+        return res
+
+    @stage("cache.save")
+    def save(self, key, obj):
+        """Stores obj, TypeError is raised if it can not be cached"""
+        arrays = {}
+        structure = json.dumps(_encode(obj, arrays))
+        path = self.__path(key)
+        with open(path + ".tmp", 'wb') as file:
+            np.savez_compressed(file, __structure__=np.array(structure), **arrays)
+        os.replace(path + ".tmp", path)
+        self.__index[key] = {"size": os.path.getsize(path), "time": time.time()}
+        self.__index.move_to_end(key)
+        self.__evict()
+        self.__write_index()
+
+    def __evict(self):
+        size = self.get_size()
+        while size > self.__max_size and len(self.__index) > 1:
+            key, entry = self.__index.popitem(last=False)
+            size -= entry["size"]
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in list(self.__index):
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+        self.__index.clear()
+        self.__write_index()
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """:return cached result for key or result of func(*args, **kwargs) that is cached"""
+        if key in self:
+            return self.load(key)
+        res = func(*args, **kwargs)
+        try:
+            self.save(key, res)
+        except TypeError:
+            pass
+        return res
+
+    def memoize(self, func):
+        """
+        Decorator that caches results of func by its code and content of its arguments,
+        calls with arguments that can not be hashed by content are not cached
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                key = Cache.get_key(func, args, kwargs)
+            except TypeError:
+                return func(*args, **kwargs)
+            return self.get_or_compute(key, func, *args, **kwargs)
+        return wrapper
@@ -0,0 +1,285 @@
+"""
+Fitting module
+
+Contains functions that fit data by lines and curves, they are used by Plotter
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from inspect import signature
+from time import perf_counter
+
+import numpy as np
+
+from prac_code.value import Value
+from prac_code.profiling import stage
+
+
+LineFit = namedtuple("LineFit", [
+    "a", "sigma_a",
+    "b", "sigma_b",
+    "r",
+    "cov"
+])
+CurveFit = namedtuple("CurveFit", [
+    "params", "sigma_params", "cov"
+])
+BootstrapFit = namedtuple("BootstrapFit", [
+    "params", "sigma_params", "cov",
+    "distribution",
+    "percentiles"
+])
+
+
+class Resampling:
+    PAIRS = "pairs"
+    RESIDUALS = "residuals"
+    JACKKNIFE = "jackknife"
+
+
+@stage("fitting.linear_fit", lambda x, *args: {"points": len(x)})
+def linear_fit(x, y, sigma=None):
+    """
+    Weighted least squares fit of y = a * x + b in closed form.
+    Parameter errors are scaled by reduced chi-squared like in scipy.optimize.curve_fit with absolute_sigma=False.
+    :param x: array of points, its last axis is points of one series, other axes are different series
+    :param y: array with the same shape as x
+    :param sigma: errors of y or None, series with nonpositive errors are fitted with equal weights
+    :return LineFit(a, sigma_a, b, sigma_b, r, cov), r is Pearson correlation coefficient of x and y,
+    cov is covariance matrix of (a, b), every field is scalar (matrix) for one series or array for many of them
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x, y = np.broadcast_arrays(x, y)
+    if sigma is None:
+        w = np.ones_like(x)
+    else:
+        sigma = np.broadcast_to(np.asarray(sigma, dtype=float), x.shape)
+        valid = np.all(sigma > 0, axis=-1, keepdims=True)
+        w = np.where(valid, 1.0 / np.where(sigma > 0, sigma, 1.0) ** 2, 1.0)
+    n = x.shape[-1]
+
+    s = w.sum(axis=-1)
+    sx = (w * x).sum(axis=-1)
+    sy = (w * y).sum(axis=-1)
+    sxx = (w * x * x).sum(axis=-1)
+    sxy = (w * x * y).sum(axis=-1)
+    delta = s * sxx - sx ** 2
+    a = (s * sxy - sx * sy) / delta
+    b = (sxx * sy - sx * sxy) / delta
+
+    residuals = y - (a[..., np.newaxis] * x + b[..., np.newaxis])
+    chi2 = (w * residuals ** 2).sum(axis=-1)
+    scale = chi2 / (n - 2) if n > 2 else np.full_like(chi2, np.inf)
+    cov = np.stack([
+        np.stack([s, -sx], axis=-1),
+        np.stack([-sx, sxx], axis=-1)
+    ], axis=-2) * (scale / delta)[..., np.newaxis, np.newaxis]
+    sigma_a = np.sqrt(cov[..., 0, 0])
+    sigma_b = np.sqrt(cov[..., 1, 1])
+
+    dx = x - x.mean(axis=-1, keepdims=True)
+    dy = y - y.mean(axis=-1, keepdims=True)
+    r = (dx * dy).sum(axis=-1) / np.sqrt((dx * dx).sum(axis=-1) * (dy * dy).sum(axis=-1))
+    return LineFit(a[()], sigma_a[()], b[()], sigma_b[()], r[()], cov)
+
+
+def _odr_errors(sigma):
+    """:return errors for scipy.odr: None if there are no errors, nonpositive errors are replaced by the least one"""
+    sigma = np.asarray(sigma, dtype=float)
+    if not np.any(sigma > 0):
+        return None
+    return np.where(sigma > 0, sigma, sigma[sigma > 0].min())
+
+
+def line_jacobian(x, a, b):
+    """:return (df/dparams, df/dx) of f(x, a, b) = a * x + b"""
+    return np.array([x, np.ones_like(x)]), np.full_like(x, a)
+
+
+@stage("fitting.odr_fit", lambda func, x, *args, **kwargs: {"points": len(x)})
+def odr_fit(func, x, y, sigma_x, sigma_y, p0=None, jac=None):
+    """
+    Orthogonal distance regression that takes errors of both x and y into account
+    :param func: func(x, *params) like in scipy.optimize.curve_fit, it must work with arrays
+    :param sigma_x, sigma_y: errors of x and y, x without errors is fitted by ordinary least squares
+    :param p0: initial params, ones by default
+    :param jac: jac(x, *params) that returns (df/dparams with shape (len(params), len(x)), df/dx with shape of x)
+    :return CurveFit(params, sigma_params, cov), cov is covariance matrix scaled by residual variance
+    """
+    from scipy import odr
+    if p0 is None:
+        p0 = np.ones(len(signature(func).parameters) - 1)
+    sx = _odr_errors(sigma_x)
+    data = odr.RealData(x, y, sx=sx, sy=_odr_errors(sigma_y))
+    if jac is not None:
+        model = odr.Model(
+            lambda beta, t: func(t, *beta),
+            fjacb=lambda beta, t: jac(t, *beta)[0],
+            fjacd=lambda beta, t: jac(t, *beta)[1]
+        )
+    else:
+        model = odr.Model(lambda beta, t: func(t, *beta))
+    solver = odr.ODR(data, model, beta0=np.asarray(p0, dtype=float))
+    solver.set_job(fit_type=0 if sx is not None else 2, deriv=3 if jac is not None else 0)
+    output = solver.run()
+    cov = output.cov_beta * output.res_var
+    return CurveFit(output.beta, np.sqrt(np.diag(cov)), cov)
+
+
+def get_correlated_values(params, cov=None, sigma_params=None):
+    """:return list of Values of fitted params, they are correlated by cov or independent with sigma_params"""
+    if cov is None:
+        return [Value(float(p), float(sigma)) for p, sigma in zip(params, sigma_params)]
+    return Value.correlated(params, cov)
+
+
+def confidence_band(func, x, params, cov):
+    """
+    Evaluates fitted curve with its error over whole grid in one call, errors of params are correlated
+    :param func: func(x, *params) that works with arrays
+    :return (y, sigma_y) tuple of arrays
+    """
+    x = np.asarray(x, dtype=float)
+    params = np.asarray(params, dtype=float)
+    y = np.asarray(func(x, *params), dtype=float)
+    steps = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(params), 1.0)
+    jacobian = np.empty((len(params),) + y.shape)
+    for i, step in enumerate(steps):
+        shifted = params.copy()
+        shifted[i] += step
+        jacobian[i] = (np.asarray(func(x, *shifted), dtype=float) - y) / step
+    variance = np.einsum('i...,ij,j...->...', jacobian, np.asarray(cov, dtype=float), jacobian)
+    return y, np.sqrt(np.clip(variance, 0.0, None))
+
+
+def line(x, a, b):
+    """:return a * x + b, it is picklable model of straight line"""
+    return x * a + b
+
+
+def _fit_samples(job):
+    """
+    Fits every resampled series of chunk one by one, it is used by bootstrap_fit in worker processes
+    :param job: (func, p0, jac, odr, x, y, sigma_x, sigma_y) with arrays of shape (samples, points)
+    :return array of params with shape (samples, len(p0)), failed fits are nan
+    """
+    from scipy.optimize import curve_fit
+    func, p0, jac, use_odr, xs, ys, sxs, sys = job
+    res = np.full((len(xs), len(p0)), np.nan)
+    for i in range(len(xs)):
+        try:
+            if use_odr:
+                res[i] = odr_fit(func, xs[i], ys[i], sxs[i], sys[i], p0, jac).params
+            else:
+                sigma = sys[i] if np.all(sys[i] > 0) else None
+                res[i] = curve_fit(func, xs[i], ys[i], p0=p0, sigma=sigma)[0]
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            pass
+    return res
+
+
+@stage("fitting.bootstrap_fit", lambda x, *args, **kwargs: {"points": len(x)})
+def bootstrap_fit(x, y, sigma_y=None, **kwargs):
+    """
+    Estimates distribution of fitted params by refitting resampled data
+    Straight lines are refitted in vectorized linear_fit calls, curves and ODR fits are refitted
+    chunk by chunk in process pool if it is given, func and jac must be picklable in this case
+    :param x, y: arrays of points
+    :param sigma_y: errors of y or None
+    :param kwargs: func (straight line by default), p0, jac, sigma_x and odr (False by default) like in odr_fit,
+    method (Resampling.PAIRS by default, RESIDUALS or JACKKNIFE), samples (1000 by default, ignored by JACKKNIFE),
+    seed (None by default, fixed seed makes result reproducible), chunk (size of chunk, 1000 by default),
+    percentiles ((2.5, 97.5) by default), executor (concurrent.futures executor) or num_proc (1 by default),
+    progress (progress(done, total, elapsed) is called after every chunk)
+    :return BootstrapFit(params, sigma_params, cov, distribution, percentiles), params are fitted by whole data,
+    distribution has shape (samples, len(params)) and percentiles is dict {percentile: params}
+    """
+    func = kwargs['func'] if 'func' in kwargs and kwargs['func'] is not None else None
+    use_odr = kwargs['odr'] if 'odr' in kwargs else False
+    method = kwargs['method'] if 'method' in kwargs else Resampling.PAIRS
+    samples = kwargs['samples'] if 'samples' in kwargs else 1000
+    chunk = kwargs['chunk'] if 'chunk' in kwargs else 1000
+    percentiles = kwargs['percentiles'] if 'percentiles' in kwargs else (2.5, 97.5)
+    executor = kwargs['executor'] if 'executor' in kwargs else None
+    num_proc = kwargs['num_proc'] if 'num_proc' in kwargs else 1
+    progress = kwargs['progress'] if 'progress' in kwargs else None
+    jac = kwargs['jac'] if 'jac' in kwargs else None
+    p0 = kwargs['p0'] if 'p0' in kwargs else None
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    sigma_y = np.zeros(n) if sigma_y is None else np.broadcast_to(np.asarray(sigma_y, dtype=float), (n,))
+    sigma_x = np.zeros(n) if 'sigma_x' not in kwargs or kwargs['sigma_x'] is None else \
+        np.broadcast_to(np.asarray(kwargs['sigma_x'], dtype=float), (n,))
+    vectorized = func is None and not use_odr
+    if func is None:
+        func = line
+        jac = line_jacobian if jac is None else jac
+    if p0 is None:
+        p0 = np.ones(len(signature(func).parameters) - 1)
+
+    def fit(xs, ys, sxs, sys):
+        if vectorized:
+            res = linear_fit(xs, ys, sys)
+            return np.stack([np.atleast_1d(res.a), np.atleast_1d(res.b)], axis=-1)
+        return _fit_samples((func, p0, jac, use_odr, xs, ys, sxs, sys))
+
+    params = fit(x[np.newaxis], y[np.newaxis], sigma_x[np.newaxis], sigma_y[np.newaxis])[0]
+    if np.any(np.isnan(params)):
+        raise RuntimeError("fit of whole data failed")
+    p0 = params
+
+    rng = np.random.default_rng(kwargs['seed'] if 'seed' in kwargs else None)
+    fitted = func(x, *params)
+    weighted = np.all(sigma_y > 0)
+    residuals = (y - fitted) / sigma_y if weighted else y - fitted
+    if method == Resampling.JACKKNIFE:
+        samples = n
+
+    def make_job(start, stop):
+        if method == Resampling.JACKKNIFE:
+            rows = np.arange(start, stop)[:, np.newaxis]
+            index = np.arange(n - 1)[np.newaxis, :]
+            index = index + (index >= rows)
+        else:
+            index = rng.integers(0, n, (stop - start, n))
+        if method == Resampling.RESIDUALS:
+            ys = fitted + (residuals[index] * sigma_y if weighted else residuals[index])
+            return (func, p0, jac, use_odr, np.broadcast_to(x, ys.shape), ys,
+                    np.broadcast_to(sigma_x, ys.shape), np.broadcast_to(sigma_y, ys.shape))
+        return func, p0, jac, use_odr, x[index], y[index], sigma_x[index], sigma_y[index]
+
+    bounds = [(start, min(start + chunk, samples)) for start in range(0, samples, chunk)]
+    start_time = perf_counter()
+    own_executor = None
+    if executor is None and num_proc > 1 and not vectorized:
+        executor = own_executor = ProcessPoolExecutor(num_proc)
+    try:
+        jobs = (make_job(start, stop) for start, stop in bounds)
+        if vectorized:
+            results = (fit(*job[4:]) for job in jobs)
+        elif executor is not None:
+            results = executor.map(_fit_samples, list(jobs))
+        else:
+            results = map(_fit_samples, jobs)
+        distribution = []
+        for (start, stop), res in zip(bounds, results):
+            distribution.append(res)
+            if progress is not None:
+                progress(stop, samples, perf_counter() - start_time)
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+    distribution = np.concatenate(distribution)
+
+    valid = distribution[np.all(np.isfinite(distribution), axis=-1)]
+    if method == Resampling.JACKKNIFE:
+        deviations = valid - valid.mean(axis=0)
+        cov = deviations.T @ deviations * (len(valid) - 1) / len(valid)
+    else:
+        cov = np.atleast_2d(np.cov(valid, rowvar=False))
+    return BootstrapFit(
+        params, np.sqrt(np.diag(cov)), cov, distribution,
+        dict(zip(percentiles, np.percentile(valid, percentiles, axis=0)))
+    )
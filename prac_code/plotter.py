@@ -1,12 +1,14 @@
-from matplotlib import pyplot as plt
 from collections import namedtuple
 from os.path import join
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
-from scipy.stats import pearsonr
-from scipy.optimize import curve_fit
+from prac_code.value import Value, ValueArray
+from prac_code.cache import Cache
+from prac_code.profiling import stage, timed
+from prac_code.fitting import linear_fit, odr_fit, line_jacobian, get_correlated_values, confidence_band, \
+    bootstrap_fit, Resampling
 
 
 class Plotter:
@@ -19,19 +21,48 @@ class Plotter:
         'fit',
         'legend',
         'func',
-        'p0'
-    ])
+        'p0',
+        'method',
+        'jac',
+        'bootstrap'
+    ], defaults=(None, None, None))
+    Line.__qualname__ = "Plotter.Line"
 
-    FitParameters = namedtuple("FitParameters", [
+    class FitParameters(namedtuple("FitParameters", [
         "legend",
         "a", "sigma_a",
         "b", "sigma_b",
-        "r"
-    ])
-    FitParametersNonLinear = namedtuple("FitParametersNonLinear", [
+        "r",
+        "cov",
+        "bootstrap"
+    ], defaults=(None, None))):
+        __slots__ = ()
+
+        def get_values(self):
+            """:return (a, b) Values that are correlated by covariance of fit"""
+            return tuple(get_correlated_values((self.a, self.b), self.cov, (self.sigma_a, self.sigma_b)))
+
+        def get_band(self, x):
+            """:return (y, sigma_y) arrays of fitted line on grid x"""
+            cov = self.cov if self.cov is not None else np.diag([self.sigma_a ** 2, self.sigma_b ** 2])
+            return confidence_band(lambda t, a, b: t * a + b, x, (self.a, self.b), cov)
+
+    class FitParametersNonLinear(namedtuple("FitParametersNonLinear", [
         "legend",
         "params", "sigma_params",
-    ])
+        "cov",
+        "bootstrap"
+    ], defaults=(None, None))):
+        __slots__ = ()
+
+        def get_values(self):
+            """:return list of Values of params that are correlated by covariance of fit"""
+            return get_correlated_values(self.params, self.cov, self.sigma_params)
+
+        def get_band(self, func, x):
+            """:return (y, sigma_y) arrays of fitted func on grid x"""
+            cov = self.cov if self.cov is not None else np.diag(np.asarray(self.sigma_params) ** 2)
+            return confidence_band(func, x, self.params, cov)
 
     @staticmethod
     def get_new_line(**kwargs):
@@ -44,9 +75,18 @@ class Plotter:
             kwargs['fit'],
             kwargs['legend'],
             kwargs['func'] if 'func' in kwargs else None,
-            kwargs['p0'] if 'p0' in kwargs else None
+            kwargs['p0'] if 'p0' in kwargs else None,
+            kwargs['method'] if 'method' in kwargs else None,
+            kwargs['jac'] if 'jac' in kwargs else None,
+            kwargs['bootstrap'] if 'bootstrap' in kwargs else None
         )
 
+    class Method:
+        LEAST_SQUARES = "least_squares"
+        ODR = "odr"
+
+    Resampling = Resampling
+
     class Scale:
         LOG = "log"
         LINEAR = "linear"
@@ -59,6 +99,12 @@ class Plotter:
     PLT_XSCALE = "linear"
     NUM_PROC = 5
     NUM_POINTS = 100
+    PARALLEL_SIZE = 50000
+    EXECUTOR = None
+    BOOTSTRAP_SAMPLES = 1000
+    BOOTSTRAP_SEED = None
+    BOOTSTRAP_PROGRESS = None
+    CACHE = None
 
     def __init__(self, **kwargs):
         self.__lines = kwargs['lines'] if 'lines' in kwargs else []
@@ -118,100 +164,238 @@ class Plotter:
             name=self.__name
         )
 
-    def __create(self):
-        plt.figure(num=1, figsize=(8, 6))
-        plt.title(self.__title, size=14, loc='center')
-        plt.xlabel(self.__axis_x, size=14)
-        plt.ylabel(self.__axis_y, size=14)
-        plt.yscale(Plotter.PLT_YSCALE)
-        plt.xscale(Plotter.PLT_XSCALE)
+    def __create(self, ax):
+        ax.set_title(self.__title, size=14, loc='center')
+        ax.set_xlabel(self.__axis_x, size=14)
+        ax.set_ylabel(self.__axis_y, size=14)
+        ax.set_yscale(Plotter.PLT_YSCALE)
+        ax.set_xscale(Plotter.PLT_XSCALE)
 
     @staticmethod
     def get_tup(x):
-        return x.get_value_error()
+        if isinstance(x, Value):
+            return x.get_value_error()
+        return x, 0.0
+
+    @staticmethod
+    def start_executor(num_proc=None):
+        """Starts process pool that is shared by all plot() calls and used for long series of Values"""
+        if Plotter.EXECUTOR is None:
+            Plotter.EXECUTOR = ProcessPoolExecutor(num_proc if num_proc is not None else Plotter.NUM_PROC)
+        return Plotter.EXECUTOR
+
+    @staticmethod
+    def stop_executor():
+        if Plotter.EXECUTOR is not None:
+            Plotter.EXECUTOR.shutdown()
+            Plotter.EXECUTOR = None
+
+    @staticmethod
+    def get_value_error_arrays(values):
+        """
+        :param values: ValueArray or series of Values or numbers
+        :return (values, errors) tuple of float arrays
+        ValueArray is extracted in one vectorized call, series of Values are extracted in this process
+        or by Plotter.EXECUTOR if it is started and series has at least Plotter.PARALLEL_SIZE elements
+        """
+        if isinstance(values, ValueArray):
+            val, er = values.get_value_error()
+            return np.ravel(val).astype(float), np.ravel(er).astype(float)
+        values = list(values)
+        parallel = Plotter.EXECUTOR is not None and len(values) >= Plotter.PARALLEL_SIZE
+        with timed("plotter.get_value_error_arrays", values=len(values), parallel=int(parallel)):
+            if parallel:
+                chunksize = max(1, len(values) // (4 * Plotter.NUM_PROC))
+                tups = Plotter.EXECUTOR.map(Plotter.get_tup, values, chunksize=chunksize)
+            else:
+                tups = map(Plotter.get_tup, values)
+            val_error = np.array([[float(val), float(er)] for val, er in tups]).reshape(-1, 2)
+        return val_error[::, 0], val_error[::, 1]
 
     @staticmethod
     def __line_fit(line, x_data, y_data, sigmay):
-        (res_a, res_b), pcov = curve_fit(lambda x, a, b: x * a + b, x_data, y_data, sigma=sigmay)
-        a_deviation, b_deviation = np.sqrt(np.diag(pcov))
-        line_r = pearsonr(x_data, y_data)[0]
-        ffit = np.polynomial.polynomial.Polynomial((res_b, res_a))
-        y_fit = ffit(x_data)
-        plt.plot(x_data, y_fit, color=line.color, linestyle='-', marker='', linewidth=2 * Plotter.SIZE)
-        return Plotter.FitParameters(line.legend, res_a, a_deviation, res_b, b_deviation, line_r)
+        res_a, a_deviation, res_b, b_deviation, line_r, pcov = linear_fit(x_data, y_data, sigmay)
+        return Plotter.FitParameters(line.legend, res_a, a_deviation, res_b, b_deviation, line_r, pcov)
 
     @staticmethod
     def __nonlinear_fit(line, x_data, y_data, sigmay):
-        if line.p0 is not None:
-            res_params, pcov = curve_fit(line.func, x_data, y_data, p0=line.p0, sigma=sigmay)
+        from scipy.optimize import curve_fit
+        with timed("fitting.curve_fit", points=len(x_data)):
+            if line.p0 is not None:
+                res_params, pcov = curve_fit(line.func, x_data, y_data, p0=line.p0, sigma=sigmay)
+            else:
+                res_params, pcov = curve_fit(line.func, x_data, y_data, sigma=sigmay)
+        return Plotter.FitParametersNonLinear(line.legend, res_params, np.sqrt(np.diag(pcov)), pcov)
+
+    @staticmethod
+    def __odr_fit(line, x_data, y_data, sigmax, sigmay):
+        if line.func is None:
+            res_params, sigma_params, pcov = odr_fit(
+                lambda x, a, b: x * a + b, x_data, y_data, sigmax, sigmay, line.p0, line_jacobian
+            )
+            return Plotter.FitParameters(
+                line.legend, res_params[0], sigma_params[0], res_params[1], sigma_params[1],
+                linear_fit(x_data, y_data).r, pcov
+            )
+        res_params, sigma_params, pcov = odr_fit(line.func, x_data, y_data, sigmax, sigmay, line.p0, line.jac)
+        return Plotter.FitParametersNonLinear(line.legend, res_params, sigma_params, pcov)
+
+    @staticmethod
+    def __bootstrap(fit, line, x_data, y_data, sigmax, sigmay):
+        """
+        :return fit with errors and covariance of params estimated by line.bootstrap resampling method,
+        resampled fits are run by Plotter.EXECUTOR if it is started
+        """
+        res = bootstrap_fit(
+            x_data, y_data, sigmay,
+            func=line.func, p0=line.p0, jac=line.jac,
+            sigma_x=sigmax, odr=line.method == Plotter.Method.ODR,
+            method=line.bootstrap, samples=Plotter.BOOTSTRAP_SAMPLES, seed=Plotter.BOOTSTRAP_SEED,
+            executor=Plotter.EXECUTOR, progress=Plotter.BOOTSTRAP_PROGRESS
+        )
+        if isinstance(fit, Plotter.FitParameters):
+            return fit._replace(sigma_a=res.sigma_params[0], sigma_b=res.sigma_params[1], cov=res.cov, bootstrap=res)
+        return fit._replace(sigma_params=res.sigma_params, cov=res.cov, bootstrap=res)
+
+    @staticmethod
+    @stage("plotter.fit_line", lambda line, x_data, *args: {"points": len(x_data)})
+    def fit_line(line, x_data, y_data, sigmax, sigmay):
+        """:return fit results of line with data arrays without drawing"""
+        if line.method == Plotter.Method.ODR:
+            fit = Plotter.__odr_fit(line, x_data, y_data, sigmax, sigmay)
+        elif line.func is None:
+            fit = Plotter.__line_fit(line, x_data, y_data, sigmay)
         else:
-            res_params, pcov = curve_fit(line.func, x_data, y_data, sigma=sigmay)
-        x_fit = np.linspace(x_data.min(), x_data.max(), Plotter.NUM_POINTS)
-        y_fit = line.func(x_fit, *res_params)
-        plt.plot(x_fit, y_fit, color=line.color, linestyle='-', marker='', linewidth=2 * Plotter.SIZE)
-        return Plotter.FitParametersNonLinear(line.legend, res_params, np.sqrt(np.diag(pcov)))
+            fit = Plotter.__nonlinear_fit(line, x_data, y_data, sigmay)
+        if line.bootstrap is not None:
+            fit = Plotter.__bootstrap(fit, line, x_data, y_data, sigmax, sigmay)
+        return fit
+
+    @staticmethod
+    def __get_fit(line, x_data, y_data, sigmax, sigmay):
+        """
+        :return fit results of line, they are loaded from Plotter.CACHE if it is set and the same line
+        was fitted with the same data before, bootstrap fits without Plotter.BOOTSTRAP_SEED are not cached
+        """
+        if Plotter.CACHE is None or (line.bootstrap is not None and Plotter.BOOTSTRAP_SEED is None):
+            return Plotter.fit_line(line, x_data, y_data, sigmax, sigmay)
+        try:
+            key = Cache.get_key(
+                "fit", line.func, line.p0, line.method, line.jac, line.bootstrap,
+                Plotter.BOOTSTRAP_SAMPLES, Plotter.BOOTSTRAP_SEED,
+                x_data, y_data, sigmax, sigmay
+            )
+        except TypeError:
+            return Plotter.fit_line(line, x_data, y_data, sigmax, sigmay)
+        fit = Plotter.CACHE.get_or_compute(key, Plotter.fit_line, line, x_data, y_data, sigmax, sigmay)
+        return fit._replace(legend=line.legend)
 
-    def __draw_lines(self):
+    @staticmethod
+    def __draw_fit(ax, line, fit, x_data):
+        if isinstance(fit, Plotter.FitParameters):
+            x_fit = x_data
+            y_fit = fit.a * x_data + fit.b
+        else:
+            x_fit = np.linspace(x_data.min(), x_data.max(), Plotter.NUM_POINTS)
+            y_fit = line.func(x_fit, *fit.params)
+        ax.plot(x_fit, y_fit, color=line.color, linestyle='-', marker='', linewidth=2 * Plotter.SIZE)
+
+    def __draw_lines(self, ax):
         fit_lines = []
         for line in self.__lines:
-            with Pool(Plotter.NUM_PROC) as p:
-                x_tup = p.map(Plotter.get_tup, line.x_value)
-                y_tup = p.map(Plotter.get_tup, line.y_value)
-
-            x_val_error = np.array(
-                list(map(
-                    lambda tup: [float(tup[0]), float(tup[1])],
-                    x_tup
-                ))
-            )
-            y_val_error = np.array(
-                list(map(
-                    lambda tup: [float(tup[0]), float(tup[1])],
-                    y_tup
-                ))
-            )
-            # x_data = [float(x.get_value_error()[0]) for x in line.x_value]
-            # y_data = [float(y.get_value_error()[0]) for y in line.y_value]
-            x_data = x_val_error[::, 0]
-            y_data = y_val_error[::, 0]
-            plt.scatter(
+            x_data, x_error = Plotter.get_value_error_arrays(line.x_value)
+            y_data, y_error = Plotter.get_value_error_arrays(line.y_value)
+            ax.scatter(
                 x_data, y_data,
                 color=line.color, marker=line.marker, s=4 * Plotter.SIZE, label=line.legend
             )
-            # sigmax = [Plotter.NUMBER_OF_SIGMA * float(x.get_value_error()[1]) for x in line.x_value]
-            # sigmay = [Plotter.NUMBER_OF_SIGMA * float(y.get_value_error()[1]) for y in line.y_value]
-            sigmax = x_val_error[::, 1] * Plotter.NUMBER_OF_SIGMA
-            sigmay = y_val_error[::, 1] * Plotter.NUMBER_OF_SIGMA
-
-            if line.fit and line.func is None:
-                fit_lines.append(Plotter.__line_fit(line, x_data, y_data, sigmay))
-            elif line.fit and line.func is not None:
-                fit_lines.append(Plotter.__nonlinear_fit(line, x_data, y_data, sigmay))
+            sigmax = x_error * Plotter.NUMBER_OF_SIGMA
+            sigmay = y_error * Plotter.NUMBER_OF_SIGMA
+
+            if line.fit:
+                fit = Plotter.__get_fit(line, x_data, y_data, sigmax, sigmay)
+                Plotter.__draw_fit(ax, line, fit, x_data)
+                fit_lines.append(fit)
             if line.draw_error:
-                plt.errorbar(x_data, y_data, ecolor=line.color,
-                             yerr=sigmay, xerr=sigmax,
-                             fmt='none', linewidth=Plotter.SIZE / 1.5)
+                ax.errorbar(x_data, y_data, ecolor=line.color,
+                            yerr=sigmay, xerr=sigmax,
+                            fmt='none', linewidth=Plotter.SIZE / 1.5)
         return fit_lines
 
-    def plot(self, **kwargs):
-        self.__create()
-        res = self.__draw_lines()
+    @stage("plotter.draw")
+    def __draw(self, ax, **kwargs):
+        self.__create(ax)
+        res = self.__draw_lines(ax)
 
-        plt.grid(linewidth=Plotter.SIZE / 3.0, linestyle='--')
-        plt.tick_params(axis='both', direction='in', which='both', width=Plotter.SIZE / 2.0)
+        ax.grid(linewidth=Plotter.SIZE / 3.0, linestyle='--')
+        ax.tick_params(axis='both', direction='in', which='both', width=Plotter.SIZE / 2.0)
         if 'ylim' in kwargs:
             ymin, ymax = kwargs['ylim']
-            plt.ylim(ymin, ymax)
+            ax.set_ylim(ymin, ymax)
 
         if 'xlim' in kwargs:
             xmin, xmax = kwargs['xlim']
-            plt.xlim(xmin, xmax)
+            ax.set_xlim(xmin, xmax)
 
         if self.__draw_legend:
-            plt.legend(loc='upper left')
+            ax.legend(loc='upper left')
+        return res
+
+    def plot(self, **kwargs):
+        from matplotlib import pyplot as plt
+        plt.figure(num=1, figsize=(8, 6))
+        res = self.__draw(plt.gca(), **kwargs)
 
         if 'save' in kwargs and kwargs['save']:
-            plt.savefig(join("images", self.__name + ".png"), format='png', dpi=300)
+            with timed("plotter.savefig"):
+                plt.savefig(join("images", self.__name + ".png"), format='png', dpi=300)
         if 'show' in kwargs and kwargs['show']:
             plt.show()
         return res
+
+    def render(self, **kwargs):
+        """
+        Draws figure with Agg canvas without pyplot global state and saves it
+        :param kwargs: directory ("images" by default), ylim, xlim
+        :return fit results like plot()
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        directory = kwargs['directory'] if 'directory' in kwargs else "images"
+        fig = Figure(figsize=(8, 6))
+        FigureCanvasAgg(fig)
+        res = self.__draw(fig.add_subplot(), **kwargs)
+        with timed("plotter.savefig"):
+            fig.savefig(join(directory, self.__name + ".png"), format='png', dpi=300)
+        return res
+
+    @staticmethod
+    def render_job(job):
+        """Renders (plotter, kwargs) pair, it is used by render_many in worker processes"""
+        plotter, kwargs = job
+        return plotter.render(**kwargs)
+
+    @staticmethod
+    @stage("plotter.render_many", lambda plotters, **kwargs: {"plotters": len(plotters)})
+    def render_many(plotters, **kwargs):
+        """
+        Renders figures concurrently in process pool, functions of lines must be picklable
+        :param plotters: list of Plotters or (Plotter, kwargs of render) pairs
+        :param kwargs: num_proc (Plotter.NUM_PROC by default, 1 renders in this process),
+        other kwargs are passed to render of every Plotter
+        :return list of fit results in order of plotters
+        """
+        num_proc = kwargs.pop('num_proc') if 'num_proc' in kwargs else Plotter.NUM_PROC
+        jobs = []
+        for plotter in plotters:
+            job_kwargs = dict(kwargs)
+            if not isinstance(plotter, Plotter):
+                plotter, own_kwargs = plotter
+                job_kwargs.update(own_kwargs)
+            jobs.append((plotter, job_kwargs))
+        if num_proc == 1 or len(jobs) <= 1:
+            return list(map(Plotter.render_job, jobs))
+        if Plotter.EXECUTOR is not None:
+            return list(Plotter.EXECUTOR.map(Plotter.render_job, jobs))
+        with ProcessPoolExecutor(num_proc) as executor:
+            return list(executor.map(Plotter.render_job, jobs))
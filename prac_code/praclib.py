@@ -1,7 +1,13 @@
-from sympy import sqrt, Symbol, diff, evaluate, latex, simplify
 from decimal import Decimal
+from functools import lru_cache
+import numpy as np
 
+from prac_code.profiling import stage
 
+DEVIATION_CACHE_SIZE = 512
+
+
+@stage("praclib.rounding")
 def rounding(value, error):
     value = Decimal(value)
     error = Decimal(error)
@@ -12,15 +18,61 @@ def rounding(value, error):
     return round(value, n), round(error, n)
 
 
+def format_rounded(value, error, digits=10):
+    """:return "value ± error" string of rounded value and error like str of Value"""
+    value, error = rounding(value, error)
+    format_string = "{:." + str(digits) + "g} {} {:." + str(digits) + "g}"
+    return format_string.format(value, chr(177), error)
+
+
+def rounding_array(values, errors, digits=10):
+    """
+    Vectorized rounding of whole columns by the rule of rounding
+    :return (decimals, fast) arrays: number of decimal places of every value and error and mask of elements
+    that are formatted by them exactly like format_rounded, other elements are too close to boundaries
+    of leading digit, have zero or too small errors or are shown in scientific notation
+    """
+    values = np.asarray(values, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    with np.errstate(all='ignore'):
+        exponent = np.floor(np.log10(errors))
+        mantissa = errors / 10.0 ** exponent
+        decimals = -exponent + (mantissa < 2.0)
+        fast = np.isfinite(values) & np.isfinite(exponent) & (errors > 0.0) & (decimals >= 0.0)
+        fast &= (np.abs(mantissa - 1.0) > 1e-9) & (np.abs(mantissa - 2.0) > 1e-9) & (np.abs(mantissa - 10.0) > 1e-9)
+        fast &= exponent >= -6.0
+        fast &= (decimals <= 6.0) | (np.abs(values) >= 1.1e-6)
+        fast &= np.abs(values) * 10.0 ** decimals < 0.9 * 10.0 ** digits
+    return np.where(fast, decimals, 0).astype(int), fast
+
+
+def format_value_error(values, errors, digits=10):
+    """
+    Formats whole columns of values with errors, rounding is vectorized by rounding_array
+    and only rare elements near boundaries are rounded through Decimal
+    :return list of "value ± error" strings that are the same as format_rounded of every element
+    """
+    values = np.ravel(np.asarray(values, dtype=float))
+    errors = np.ravel(np.broadcast_to(np.asarray(errors, dtype=float), values.shape))
+    decimals, fast = rounding_array(values, errors, digits)
+    sign = " " + chr(177) + " "
+    return [
+        "%.*f" % (n, v) + sign + "%.*f" % (n, e) if f else format_rounded(v, e, digits)
+        for v, e, n, f in zip(values.tolist(), errors.tolist(), decimals.tolist(), fast.tolist())
+    ]
+
+
 def get_pair(**kwargs):
     return kwargs['value'], kwargs['deviation']
 
 
+@stage("praclib.print_with_deviation")
 def print_with_deviation(f, dct, ignoreset=set(), notebook=True):
+    from sympy import evaluate, latex
     dct3 = {}
     for name in ignoreset:
         dct3[name] = dct[name][0]
-    f = simplify(f.subs(dct3))
+    f = get_simplified(f.subs(dct3))
     dev = get_deviation(f, dct, ignoreset)
     dct2 = dict((s, dct[s][0]) for s in dct)
     rnd = rounding(float(f.subs(dct2)), float(dev[2]))
@@ -33,17 +85,87 @@ def print_with_deviation(f, dct, ignoreset=set(), notebook=True):
     print('$$' + res + '$$')
 
 
+def get_sigma_symbol(s):
+    from sympy import Symbol
+    return Symbol('sigma_' + str(s))
+
+
+@lru_cache(maxsize=DEVIATION_CACHE_SIZE)
+@stage("praclib.simplify")
+def get_simplified(f):
+    from sympy import simplify
+    return simplify(f)
+
+
+@lru_cache(maxsize=DEVIATION_CACHE_SIZE)
+@stage("praclib.get_deviation_formula", lambda f, symbols, ignoreset: {"symbols": len(symbols)})
+def get_deviation_formula(f, symbols, ignoreset):
+    """
+    :param symbols: tuple of symbols of f
+    :param ignoreset: frozenset of symbols that are not used to calculate error
+    :return (error formula, error formula compiled as function of values and then deviations of symbols)
+    """
+    from sympy import sqrt, diff, simplify, lambdify
+    sigmas = [get_sigma_symbol(s) for s in symbols]
+    res = sqrt(sum([(diff(f, s) * sigma) ** 2 for s, sigma in zip(symbols, sigmas) if s not in ignoreset]))
+    res = simplify(res)
+    return res, lambdify(list(symbols) + sigmas, res, modules="numpy")
+
+
+@lru_cache(maxsize=DEVIATION_CACHE_SIZE)
+def get_compiled(f, symbols):
+    from sympy import lambdify
+    return lambdify(list(symbols), f, modules="numpy")
+
+
+def get_cache_info():
+    """:return dict with hits and misses of formula caches"""
+    return {
+        'deviation': get_deviation_formula.cache_info(),
+        'simplify': get_simplified.cache_info(),
+        'compiled': get_compiled.cache_info()
+    }
+
+
+@stage("praclib.propagate")
+def propagate(f, symbols, values, deviations, ignoreset=frozenset()):
+    """
+    Calculates values and errors of formula for whole columns at once.
+    Error formula is derived and compiled once, then it is evaluated with numpy arrays.
+    :param f: sympy expression or function that makes expression from symbols
+    :param symbols: list of symbols or their names
+    :param values: list of values of symbols, numbers or arrays
+    :param deviations: list of deviations of symbols, numbers or arrays
+    :param ignoreset: set of symbols or their names that are not used to calculate error
+    :return (values, errors) tuple of arrays that are not rounded
+    """
+    from sympy import Symbol, Basic, sympify
+    symbols = tuple(Symbol(s) if isinstance(s, str) else s for s in symbols)
+    ignoreset = frozenset(Symbol(s) if isinstance(s, str) else s for s in ignoreset)
+    if not isinstance(f, Basic):
+        f = f(*symbols) if callable(f) else sympify(f)
+    values = [np.asarray(v, dtype=float) for v in values]
+    deviations = [np.asarray(d, dtype=float) for d in deviations]
+    shape = np.broadcast(*values, *deviations).shape
+    _, func = get_deviation_formula(f, symbols, ignoreset)
+    res = np.broadcast_to(get_compiled(f, symbols)(*values), shape)
+    er = np.broadcast_to(func(*values, *deviations), shape)
+    return np.array(res, dtype=float), np.array(er, dtype=float)
+
+
+@stage("praclib.get_deviation", lambda f, dct, ignoreset=set(): {"symbols": len(dct)})
 def get_deviation(f, dct, ignoreset=set()):
     # {sumbol:(value, deviation)}
-    sdct = dict((s, Symbol('sigma_' + str(s))) for s in dct)
-    sdct2 = dict((sdct[s], dct[s][1]) for s in dct)
-    res = sqrt(sum([(diff(f, s) * sdct[s]) ** 2 for s in dct if s not in ignoreset]))
-    res = simplify(res)
+    from sympy import evaluate, sympify
+    symbols = tuple(sorted(dct, key=str))
+    res, func = get_deviation_formula(f, symbols, frozenset(s for s in ignoreset if s in dct))
     vls = dict((s, dct[s][0]) for s in dct)
-    vls.update(sdct2)
+    vls.update((get_sigma_symbol(s), dct[s][1]) for s in dct)
     with evaluate(False):
         step = res.subs(vls)
-    return res, step, res.subs(vls)
+    if res.is_number:
+        return res, step, res
+    return res, step, sympify(func(*[dct[s][0] for s in symbols], *[dct[s][1] for s in symbols]))
 
 
 def dict_adding(a, b):
@@ -52,6 +174,20 @@ def dict_adding(a, b):
     return res
 
 
+def get_numeric_deviation(pairs):
+    # pairs (partial derivative, deviation)
+    return sum((d * sigma) ** 2 for d, sigma in pairs) ** 0.5
+
+
+@lru_cache(maxsize=128)
+def get_numeric_function(func):
+    """:return (f, df/dx) pair of numeric functions for func that is applicable to sympy symbols"""
+    from sympy import Dummy, diff, lambdify
+    x = Dummy('x')
+    f = func(x)
+    return lambdify(x, f, modules="numpy"), lambdify(x, diff(f, x), modules="numpy")
+
+
 def cut_array(arr, how_to_cut):
     left = []
     right = []
@@ -0,0 +1,183 @@
+"""
+Profiling module
+
+Opt-in instrumentation of error propagation, rounding, symbolic derivation, fitting and plotting.
+Instrumented stages record wall time, number of calls and sizes of expressions only while Profiler is active,
+otherwise they cost one check of global variable per call.
+
+with profile() as profiler:
+    ...
+print(profiler.get_summary())
+profiler.save_trace("trace.json")
+
+Whole program is profiled if environment variable PRAC_CODE_PROFILE is set, summary is printed to stderr at exit
+and Chrome trace (chrome://tracing, https://ui.perfetto.dev) is saved if the variable is name of .json file.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import atexit
+import json
+import os
+import sys
+import threading
+
+
+ENVIRONMENT_VARIABLE = "PRAC_CODE_PROFILE"
+
+StageStats = namedtuple("StageStats", ["calls", "total", "own", "max", "sizes"])
+
+_active = None
+
+
+class Profiler:
+    """
+    Profiler class
+
+    Collects events of stages that are expected to run in one thread. Total time of stage includes stages
+    that are called inside it, own time excludes them. Sizes are numbers like symbols or depth of expression
+    that are recorded with every call, summary shows their maximal values.
+    """
+
+    def __init__(self):
+        self.__events = []
+        self.__nested = []
+        self.__origin = perf_counter()
+
+    @property
+    def events(self):
+        """:return list of (stage, start, duration, own duration, sizes, thread) tuples, times are in seconds"""
+        return list(self.__events)
+
+    def begin(self):
+        """:return start time of stage that must be passed to end()"""
+        self.__nested.append(0.0)
+        return perf_counter()
+
+    def end(self, name, start, sizes=None):
+        duration = perf_counter() - start
+        nested = self.__nested.pop()
+        if self.__nested:
+            self.__nested[-1] += duration
+        self.__events.append(
+            (name, start - self.__origin, duration, duration - nested, sizes, threading.get_ident())
+        )
+
+    def clear(self):
+        self.__events = []
+
+    def get_stats(self):
+        """:return dict {stage: StageStats} ordered by total time"""
+        stats = {}
+        for name, _, duration, own, sizes, _ in self.__events:
+            calls, total, own_total, longest, max_sizes = stats[name] if name in stats else (0, 0.0, 0.0, 0.0, {})
+            for key, size in (sizes or {}).items():
+                max_sizes[key] = max(max_sizes[key], size) if key in max_sizes else size
+            stats[name] = StageStats(calls + 1, total + duration, own_total + own, max(longest, duration), max_sizes)
+        return dict(sorted(stats.items(), key=lambda item: -item[1].total))
+
+    def get_summary(self):
+        """:return text table of stages with calls, total, own, mean and maximal times in ms and maximal sizes"""
+        lines = ["{:<36} {:>8} {:>11} {:>11} {:>10} {:>10}  {}".format(
+            "stage", "calls", "total, ms", "own, ms", "mean, ms", "max, ms", "max sizes"
+        )]
+        for name, s in self.get_stats().items():
+            lines.append("{:<36} {:>8} {:>11.3f} {:>11.3f} {:>10.3f} {:>10.3f}  {}".format(
+                name, s.calls, s.total * 1e3, s.own * 1e3, s.total / s.calls * 1e3, s.max * 1e3,
+                ", ".join("{}={}".format(key, size) for key, size in s.sizes.items())
+            ))
+        return "\n".join(lines)
+
+    def get_trace(self):
+        """:return dict in Chrome trace event format"""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": name, "cat": name.split('.')[0], "ph": "X", "pid": pid, "tid": thread,
+                    "ts": start * 1e6, "dur": duration * 1e6, "args": sizes or {}
+                }
+                for name, start, duration, _, sizes, thread in self.__events
+            ],
+            "displayTimeUnit": "ms"
+        }
+
+    def save_trace(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.get_trace(), file)
+
+
+def get_active():
+    """:return active Profiler or None"""
+    return _active
+
+
+@contextmanager
+def profile(profiler=None):
+    """
+    Context manager that activates profiler (new Profiler by default) for instrumented stages
+    :return active Profiler
+    """
+    global _active
+    old = _active
+    _active = profiler if profiler is not None else Profiler()
+    try:
+        yield _active
+    finally:
+        _active = old
+
+
+def stage(name, size=None):
+    """
+    Decorator that records calls of function as stage
+    :param size: function of the same arguments that returns dict {name: number} of sizes of call,
+    it is called only if profiler is active
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+            sizes = size(*args, **kwargs) if size is not None else None
+            start = profiler.begin()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.end(name, start, sizes)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed(name, **sizes):
+    """Context manager that records block of code as stage, kwargs are sizes of stage"""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    start = profiler.begin()
+    try:
+        yield
+    finally:
+        profiler.end(name, start, sizes or None)
+
+
+def _profile_program(target):
+    """Activates Profiler until exit of program, worker processes are not profiled"""
+    global _active
+    from multiprocessing import parent_process
+    if parent_process() is not None:
+        return
+    profiler = _active = Profiler()
+
+    def report():
+        sys.stderr.write(profiler.get_summary() + "\n")
+        if target.endswith(".json"):
+            profiler.save_trace(target)
+    atexit.register(report)
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    _profile_program(os.environ[ENVIRONMENT_VARIABLE])
@@ -0,0 +1,432 @@
+"""
+Table input and output module
+
+Contains functions that read measurement tables (.tab files of tables.Table, instrument dumps)
+chunk by chunk straight into ValueArray columns without Value object per cell,
+functions that write columns of values with errors to CSV, LaTeX and Markdown
+and functions that read and write cells of tables.Table as .tab text or typed .npz columns
+"""
+from io import StringIO
+from mmap import mmap, ACCESS_READ
+import csv
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+
+from prac_code.value import Value, ValueArray
+from prac_code.praclib import format_value_error
+from prac_code.profiling import stage
+
+
+CHUNK_SIZE = 1 << 24
+PLUS_MINUS = chr(177)
+# line with something except spaces and comment
+_DATA_LINE = re.compile(rb'^[ \t]*[^#\s]', re.MULTILINE)
+
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def _split(line, sep):
+    return [s.strip() for s in (line.split(sep) if sep is not None else line.split())]
+
+
+def _get_sep(line):
+    """:return delimiter of line: tab, comma or None for any whitespace"""
+    if '\t' in line:
+        return '\t'
+    if ',' in line:
+        return ','
+    return None
+
+
+def _blocks(filename, chunk, use_mmap):
+    """:return generator of bytes blocks of file with about chunk bytes, blocks end at line boundaries"""
+    with open(filename, 'rb') as file:
+        if use_mmap and os.fstat(file.fileno()).st_size > 0:
+            with mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+                start = 0
+                while start < len(data):
+                    stop = data.find(b'\n', min(start + chunk, len(data)) - 1)
+                    stop = len(data) if stop == -1 else stop + 1
+                    yield data[start:stop]
+                    start = stop
+            return
+        rest = b''
+        while True:
+            block = file.read(chunk)
+            if not block:
+                break
+            block = rest + block
+            stop = block.rfind(b'\n') + 1
+            if stop == 0:
+                rest = block
+                continue
+            rest = block[stop:]
+            yield block[:stop]
+        if rest:
+            yield rest
+
+
+def _parse(block, sep, ncols):
+    """:return float array with shape (rows, ncols) of text block"""
+    res = np.loadtxt(StringIO(block.decode('utf-8')), delimiter=sep, comments='#', ndmin=2)
+    return res.reshape(-1, ncols)
+
+
+def _error_columns(errors):
+    """:return set of names of columns that contain errors of other columns"""
+    return set(error for error in errors.values() if isinstance(error, str))
+
+
+def _default_columns(names, errors, syst):
+    """:return names of columns except columns of errors that are not requested themselves"""
+    error_columns = _error_columns(errors)
+    return [name for name in names if name not in error_columns or name in errors or name in syst]
+
+
+def _column(values, name, errors, syst, keys):
+    """
+    :return ValueArray of column values with independent errors of every point and shared systematic error
+    :param errors: dict {column: number or name of column of errors}, errors of other columns are taken from table
+    :param syst: dict {column: systematic error}
+    :param keys: dict {column: key of systematic error source}, it keeps correlation between chunks
+    """
+    n = len(values)
+    blocks = []
+    sources = []
+    if name in errors:
+        sigma = np.broadcast_to(np.asarray(errors[name], dtype=float), (n,))
+        if np.any(sigma != 0.0):
+            blocks.append(sparse.identity(n, format="csr"))
+            sources.append((object(), np.array(sigma)))
+    if name in syst and syst[name] != 0.0:
+        blocks.append(sparse.csr_matrix(np.ones((n, 1))))
+        sources.append((keys[name], np.array([float(syst[name])])))
+    jacobian = sparse.hstack(blocks, format="csr") if blocks else sparse.csr_matrix((n, 0))
+    return ValueArray(values=np.array(values, dtype=float), jacobian=jacobian, sources=tuple(sources))
+
+
+def _is_cell(s):
+    """:return True if s is number or "value ± error" string"""
+    return all(_is_number(part) for part in s.split(PLUS_MINUS)) if s.count(PLUS_MINUS) <= 1 else False
+
+
+def _layout(filename, kwargs):
+    """
+    Reads first lines of table
+    :return (sep, header, names, positions, width) where positions is dict {column: (position of value,
+    position of error or None)} in rows with "value ± error" cells split in two fields of width
+    """
+    with open(filename, 'r', encoding='utf-8') as file:
+        first = file.readline()
+        second = file.readline()
+    sep = kwargs['sep'] if 'sep' in kwargs else _get_sep(first)
+    cells = _split(first, sep)
+    header = kwargs['header'] if 'header' in kwargs else not all(_is_cell(s) for s in cells if s)
+    names = cells if header else list(range(len(cells)))
+    data_cells = _split(second if header else first, sep)
+    positions = {}
+    width = 0
+    for i, name in enumerate(names):
+        if i < len(data_cells) and PLUS_MINUS in data_cells[i]:
+            positions[name] = (width, width + 1)
+            width += 2
+        else:
+            positions[name] = (width, None)
+            width += 1
+    return sep, header, names, positions, width
+
+
+def _raw_chunks(filename, kwargs, sep, header, width):
+    """:return generator of float arrays with shape (rows, width), "value ± error" cells are split in two fields"""
+    chunk = kwargs['chunk'] if 'chunk' in kwargs else CHUNK_SIZE
+    use_mmap = kwargs['mmap'] if 'mmap' in kwargs else False
+    split = (sep if sep is not None else ' ').encode()
+    for i, block in enumerate(_blocks(filename, chunk, use_mmap)):
+        if i == 0 and header:
+            block = block[block.find(b'\n') + 1:] if b'\n' in block else b''
+        if not _DATA_LINE.search(block):
+            # blocks of header or comments only
+            continue
+        data = _parse(block.replace(PLUS_MINUS.encode(), split), sep, width)
+        if len(data) != 0:
+            yield data
+
+
+def _columns(data, columns, positions, errors, syst, keys):
+    """:return dict {column: ValueArray} of parsed rows"""
+    data_errors = {}
+    for name in columns:
+        if positions[name][1] is not None:
+            data_errors[name] = data[:, positions[name][1]]
+    for name, error in errors.items():
+        data_errors[name] = data[:, positions[error][0]] if isinstance(error, str) else error
+    return {name: _column(data[:, positions[name][0]], name, data_errors, syst, keys) for name in columns}
+
+
+def _prepare(filename, kwargs):
+    """:return (sep, header, width, columns, positions, errors, syst) of table and kwargs of iter_table"""
+    syst = kwargs['syst'] if 'syst' in kwargs else {}
+    errors = kwargs['errors'] if 'errors' in kwargs else {}
+    sep, header, names, positions, width = _layout(filename, kwargs)
+    columns = kwargs['columns'] if 'columns' in kwargs else \
+        [name for name in _default_columns(names, errors, syst) if name != '']
+    for name in set(columns) | _error_columns(errors):
+        if name not in positions:
+            raise KeyError("there is no column {} in {}".format(name, filename))
+    return sep, header, width, columns, positions, errors, syst
+
+
+def iter_table(filename, **kwargs):
+    """
+    Reads table chunk by chunk, every chunk is parsed in one numpy call
+    :param filename: text table with tab, comma or whitespace delimiters, lines that start with # are skipped,
+    cells can be "value ± error" strings like in files written by write_table or DataFrame.to_csv(),
+    their errors are independent errors of every point
+    :param kwargs:
+    sep -- delimiter, it is detected by first line by default
+    header -- True if first line contains names of columns, it is detected by default,
+    columns are numbered from 0 if there is no header
+    columns -- list of names of columns to read, all named columns by default (index column of CSV is skipped)
+    syst -- dict {column: error} of systematic errors that are the same for all points of column,
+    they are correlated like Value(values=[0.0], syst=error) added to every point
+    errors -- dict {column: error} of independent errors of every point, error is number or name of column
+    chunk -- size of chunk in bytes (CHUNK_SIZE by default)
+    mmap -- True to read file through memory map, it is useful for huge files
+    :return generator of dicts {column: ValueArray}
+    """
+    sep, header, width, columns, positions, errors, syst = _prepare(filename, kwargs)
+    keys = {name: object() for name in syst}
+    for data in _raw_chunks(filename, kwargs, sep, header, width):
+        yield _columns(data, columns, positions, errors, syst, keys)
+
+
+@stage("tableio.read_table")
+def read_table(filename, **kwargs):
+    """
+    Reads whole table, kwargs are the same as in iter_table
+    :return dict {column: ValueArray}
+    """
+    sep, header, width, columns, positions, errors, syst = _prepare(filename, kwargs)
+    chunks = list(_raw_chunks(filename, kwargs, sep, header, width))
+    data = np.concatenate(chunks) if chunks else np.zeros((0, width))
+    return _columns(data, columns, positions, errors, syst, {name: object() for name in syst})
+
+
+def parse_column(strings):
+    """
+    Parses sequence of "value ± error" strings or numbers (like column of DataFrame that is read by pandas)
+    in one numpy call
+    :return ValueArray with independent errors
+    """
+    strings = [str(s) if PLUS_MINUS in str(s) else str(s) + PLUS_MINUS + "0" for s in strings]
+    data = _parse("\n".join(strings).replace(PLUS_MINUS, " ").encode(), None, 2)
+    return ValueArray(data[:, 0], data[:, 1])
+
+
+def format_column(column, digits=None):
+    """
+    :param column: ValueArray or sequence of Values and other objects
+    :param digits: number of significant digits (Value.NumberOfDigit by default)
+    :return list of strings that are the same as str of every element, Values are rounded in one vectorized call
+    """
+    digits = Value.NumberOfDigit if digits is None else digits
+    if isinstance(column, ValueArray):
+        values, errors = column.get_value_error()
+        return format_value_error(values, errors, digits)
+    column = column.tolist() if isinstance(column, np.ndarray) else list(column)
+    res = [str(x) for x in column]
+    index = [i for i, x in enumerate(column) if isinstance(x, Value)]
+    if index:
+        pairs = np.array([column[i].get_value_error(rounded=False) for i in index], dtype=float).reshape(-1, 2)
+        for i, s in zip(index, format_value_error(pairs[:, 0], pairs[:, 1], digits)):
+            res[i] = s
+    return res
+
+
+def _write_csv(file, header, rows, alignment):
+    writer = csv.writer(file, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+
+
+def _write_latex(file, header, rows, alignment):
+    file.write("\\begin{tabular}{" + alignment + "}\n\\toprule\n")
+    file.write(" & ".join(header) + " \\\\\n\\midrule\n")
+    for row in rows:
+        file.write(" & ".join(row) + " \\\\\n")
+    file.write("\\bottomrule\n\\end{tabular}\n")
+
+
+def _write_markdown(file, header, rows, alignment):
+    file.write("| " + " | ".join(header) + " |\n")
+    file.write("|" + "|".join("---:" if a == 'r' else ":---" for a in alignment) + "|\n")
+    for row in rows:
+        file.write("| " + " | ".join(row) + " |\n")
+
+
+@stage("tableio.write_table", lambda columns, **kwargs: {"columns": len(columns)})
+def write_table(columns, **kwargs):
+    """
+    Formats every cell once and writes table to all requested formats
+    :param columns: dict {name: column} or pandas DataFrame, columns are ValueArrays or sequences
+    :param kwargs:
+    csv, latex, markdown -- filenames or opened files to write table, CSV is the same as DataFrame.to_csv()
+    index -- True to write numbers of rows (index of DataFrame) as first column like DataFrame.to_csv(),
+    False or list of labels of rows, True by default for CSV and False for LaTeX and Markdown
+    header -- list of names that are written instead of names of columns
+    digits -- number of significant digits (Value.NumberOfDigit by default)
+    :return dict {format: text} for formats that are set to True instead of filename
+    """
+    digits = kwargs['digits'] if 'digits' in kwargs else None
+    names = list(columns.keys())
+    cells = [format_column(column, digits) for _, column in columns.items()]
+    height = max((len(column) for column in cells), default=0)
+    header = [str(name) for name in (kwargs['header'] if 'header' in kwargs else names)]
+    alignment = "".join(
+        'r' if getattr(column, 'dtype', np.dtype(object)).kind in 'iuf' else 'l'
+        for _, column in columns.items()
+    )
+    rows = list(zip(*cells))
+    if 'index' in kwargs and not isinstance(kwargs['index'], bool):
+        labels = [str(label) for label in kwargs['index']]
+    elif hasattr(columns, 'index'):
+        labels = [str(label) for label in columns.index]
+    else:
+        labels = [str(i) for i in range(height)]
+
+    res = {}
+    writers = {'csv': _write_csv, 'latex': _write_latex, 'markdown': _write_markdown}
+    for fmt, write in writers.items():
+        if fmt not in kwargs or kwargs[fmt] is None or kwargs[fmt] is False:
+            continue
+        labeled = kwargs['index'] is not False if 'index' in kwargs else fmt == 'csv'
+        args = ([""] + header, [(label,) + row for label, row in zip(labels, rows)], "l" + alignment) if labeled \
+            else (header, rows, alignment)
+        target = kwargs[fmt]
+        if target is True:
+            buffer = StringIO()
+            write(buffer, *args)
+            res[fmt] = buffer.getvalue()
+        elif hasattr(target, 'write'):
+            write(target, *args)
+        else:
+            with open(target, 'w', encoding='utf-8', newline='') as file:
+                write(file, *args)
+    return res
+
+
+def _cell_rows(rows):
+    """:return numpy array of strings (object) with shape (rows, columns), short rows are padded by empty cells"""
+    width = max((len(row) for row in rows), default=0)
+    if all(len(row) == width for row in rows):
+        res = np.empty((len(rows), width), dtype=object)
+        if len(rows) != 0:
+            res[:] = rows
+        return res
+    res = np.full((len(rows), width), "", dtype=object)
+    for y, row in enumerate(rows):
+        res[y, :len(row)] = row
+    return res
+
+
+def _typed_column(cells):
+    """
+    :return (column, format) where column is int or float array if it is formatted back to the same strings
+    by str or by format like "%.3f" of decimals of first cell, otherwise column is array of strings,
+    ASCII strings are stored in one byte per character
+    """
+    strings = cells.astype(str)
+    try:
+        column = strings.astype(np.int64)
+        if np.array_equal(column.astype(str), strings):
+            return column, ""
+    except (ValueError, OverflowError):
+        pass
+    try:
+        column = strings.astype(float)
+        if len(strings) != 0 and '.' in strings[0]:
+            fmt = "%.{}f".format(len(strings[0]) - strings[0].find('.') - 1)
+            if [fmt % v for v in column.tolist()] == strings.tolist():
+                return column, fmt
+        if np.array_equal(column.astype(str), strings):
+            return column, ""
+    except ValueError:
+        pass
+    try:
+        return strings.astype(bytes), ""
+    except UnicodeEncodeError:
+        return strings, ""
+
+
+def _is_header(cells):
+    return len(cells) > 1 and not all(_is_number(s) for s in cells[0] if s != '')
+
+
+def write_cells(filename, cells, **kwargs):
+    """
+    Writes cells of tables.Table, format is chosen by extension of filename
+    .npz -- every column is stored as int, float or string array, numbers are stored as numbers only if they
+    are formatted back to the same strings by str or fixed number of decimals, so cells are restored exactly
+    other -- .tab text with tab separated cells
+    :param cells: 2d array or list of rows of strings
+    :param kwargs: header -- True if first row contains names of columns (.npz only), it is detected by default
+    units -- list of units of columns (.npz only)
+    """
+    cells = cells if isinstance(cells, np.ndarray) else _cell_rows([[str(s) for s in row] for row in cells])
+    if not filename.endswith('.npz'):
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(['\t'.join(row) for row in cells.tolist()]))
+        return
+    header = (kwargs['header'] if 'header' in kwargs else _is_header(cells)) and len(cells) != 0
+    arrays = {"shape": np.array(cells.shape)}
+    if header:
+        arrays["header"] = cells[0].astype(str)
+        cells = cells[1:]
+    if 'units' in kwargs and kwargs['units'] is not None:
+        if len(kwargs['units']) != cells.shape[1]:
+            raise ValueError("there are {} units for {} columns".format(len(kwargs['units']), cells.shape[1]))
+        arrays["units"] = np.array(kwargs['units'], dtype=str)
+    formats = []
+    for x in range(cells.shape[1]):
+        arrays["c{}".format(x)], fmt = _typed_column(cells[:, x])
+        formats.append(fmt)
+    arrays["formats"] = np.array(formats, dtype=str)
+    np.savez(filename, **arrays)
+
+
+def read_cells(filename):
+    """
+    Reads cells written by write_cells or tables.Table, ValueError is raised if file is not such table
+    :return (cells, units) tuple, cells is 2d array of strings (object), units is list of units of columns or None
+    """
+    if not filename.endswith('.npz'):
+        with open(filename, 'r', encoding='utf-8') as file:
+            text = file.read()
+        text = text[:-1] if text.endswith('\n') else text
+        return _cell_rows([line.split('\t') for line in text.split('\n')] if text else []), None
+    try:
+        with np.load(filename, allow_pickle=False) as data:
+            rows, cols = (int(n) for n in data["shape"])
+            cells = np.empty((rows, cols), dtype=object)
+            start = 0
+            if "header" in data:
+                cells[0] = data["header"].tolist()
+                start = 1
+            formats = data["formats"].tolist()
+            for x in range(cols):
+                column = data["c{}".format(x)]
+                fmt = formats[x]
+                cells[start:, x] = [fmt % v for v in column.tolist()] if fmt else column.astype(str).tolist()
+            units = data["units"].tolist() if "units" in data else None
+    except KeyError as e:
+        raise ValueError("{} is not table of cells: there is no array {}".format(filename, e))
+    return cells, units
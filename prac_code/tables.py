@@ -7,6 +7,8 @@ def start(table=None) for making new Table window
 """
 import tkinter as tk
 
+import numpy as np
+
 
 class ModalWindow(tk.Toplevel):
     def __init__(self, master, function, labeltext, buttontext):
@@ -22,112 +24,205 @@ class ModalWindow(tk.Toplevel):
 
 
 class Table(tk.Frame):
+    """
+    Table class
+
+    Cells are kept in numpy array of strings self.data, only window of Table.VISIBLE_ROWS x Table.VISIBLE_COLS
+    cells has Entry widgets (self.table) that are reused when table is scrolled,
+    so loading and resizing create or move only visible widgets
+    """
+
+    VISIBLE_ROWS = 20
+    VISIBLE_COLS = 8
+
     def __init__(self, **kwargs):
         master = kwargs['master'] if "master" in kwargs else None
         super().__init__(master)
         self.master = master
         self.grid()
+        self.data = np.full((3, 5), "", dtype=object)
         self.table = []
         self.rowlabels = []
         self.collabels = []
-        self.colnum = 5
-        self.rownum = 3
+        self.top = self.left = 0
+        self.units = None
         self.add_col_button = self.add_row_button = None
         self.del_col_button = self.del_row_button = None
         self.save_button = self.load_button = None
+        self.xscroll = self.yscroll = None
         self.create_widgets()
-        # self.focus_x = self.focus_y = 0
         if "table" in kwargs:
             self.load_table(kwargs["table"])
 
+    @property
+    def rownum(self):
+        return self.data.shape[0]
+
+    @property
+    def colnum(self):
+        return self.data.shape[1]
+
+    def store_visible(self):
+        """Copies text of visible Entry widgets to self.data"""
+        for y, row in enumerate(self.table):
+            for x, entry in enumerate(row):
+                self.data[self.top + y, self.left + x] = entry.get()
+
+    def get_table(self):
+        """:return list of rows of strings"""
+        self.store_visible()
+        return self.data.tolist()
+
+    def show(self):
+        """Fits Entry widgets to window of table from (self.top, self.left) and fills them by self.data"""
+        self.top = max(min(self.top, self.rownum - Table.VISIBLE_ROWS), 0)
+        self.left = max(min(self.left, self.colnum - Table.VISIBLE_COLS), 0)
+        self.resize_window(min(self.rownum, Table.VISIBLE_ROWS), min(self.colnum, Table.VISIBLE_COLS))
+        for x, label in enumerate(self.collabels):
+            label.configure(text='{}'.format(self.left + x))
+        for y, row in enumerate(self.table):
+            self.rowlabels[y].configure(text='{}'.format(self.top + y))
+            for x, entry in enumerate(row):
+                entry.delete(0, tk.END)
+                entry.insert(0, self.data[self.top + y, self.left + x])
+        self.yscroll.set(*self.__fractions(self.top, len(self.table), self.rownum))
+        self.xscroll.set(*self.__fractions(self.left, len(self.collabels), self.colnum))
+
+    @staticmethod
+    def __fractions(position, visible, size):
+        if size == 0:
+            return 0.0, 1.0
+        return position / size, (position + visible) / size
+
+    def resize_window(self, rows, cols):
+        """Creates or destroys Entry widgets and labels so that window has rows x cols cells"""
+        while len(self.table) > rows:
+            for entry in self.table.pop():
+                entry.destroy()
+            self.rowlabels.pop().destroy()
+        while len(self.collabels) > cols:
+            self.collabels.pop().destroy()
+            for row in self.table:
+                row.pop().destroy()
+        while len(self.collabels) < cols:
+            x = len(self.collabels)
+            self.collabels.append(tk.Label(self))
+            self.collabels[x].grid(row=0, column=x + 1)
+            for y, row in enumerate(self.table):
+                row.append(self.create_entry(y, x))
+        while len(self.table) < rows:
+            y = len(self.table)
+            self.rowlabels.append(tk.Label(self))
+            self.rowlabels[y].grid(row=y + 1, column=0)
+            self.table.append([self.create_entry(y, x) for x in range(cols)])
+
+    def create_entry(self, y, x):
+        entry = tk.Entry(self)
+        entry.grid(row=y + 1, column=x + 1)
+        self.entry_bind(y, x, entry)
+        return entry
+
+    def scroll_to(self, top, left):
+        self.store_visible()
+        self.top, self.left = top, left
+        self.show()
+
+    @staticmethod
+    def __view_position(args, position, visible, size):
+        """:return new position of window by arguments of Scrollbar command"""
+        if args[0] == 'moveto':
+            return int(round(float(args[1]) * size))
+        return position + int(args[1]) * (visible if args[2] == 'pages' else 1)
+
+    def yview(self, *args):
+        self.scroll_to(Table.__view_position(args, self.top, len(self.table), self.rownum), self.left)
+
+    def xview(self, *args):
+        self.scroll_to(self.top, Table.__view_position(args, self.left, len(self.collabels), self.colnum))
+
     def change_size(self, xsize, ysize):
-        while ysize < self.rownum:
-            self.del_row(self.rownum - 1)
-        while ysize > self.rownum:
-            self.add_row(self.rownum)
-        while xsize < self.colnum:
-            self.del_col(self.colnum - 1)
-        while xsize > self.colnum:
-            self.add_col(self.colnum)
+        self.store_visible()
+        data = np.full((ysize, xsize), "", dtype=object)
+        rows, cols = min(ysize, self.rownum), min(xsize, self.colnum)
+        data[:rows, :cols] = self.data[:rows, :cols]
+        self.data = data
+        self.show()
 
     def change_focus(self, tup_s, tup):
-        row, entry = tup_s
-        focus_x = row.index(entry)
-        focus_y = self.table.index(row)
-        focus_x = max(min(focus_x + tup[0], self.colnum - 1), 0)
-        focus_y = max(min(focus_y + tup[1], self.rownum - 1), 0)
-        # print(focus_y, focus_x, tup)
-        self.table[focus_y][focus_x].focus_set()
+        """
+        :param tup_s: (row, column) of focused Entry in window
+        :param tup: (dx, dy) step of focus, table is scrolled if focus leaves window
+        """
+        focus_x = max(min(self.left + tup_s[1] + tup[0], self.colnum - 1), 0)
+        focus_y = max(min(self.top + tup_s[0] + tup[1], self.rownum - 1), 0)
+        top = min(max(self.top, focus_y - len(self.table) + 1), focus_y)
+        left = min(max(self.left, focus_x - len(self.collabels) + 1), focus_x)
+        if (top, left) != (self.top, self.left):
+            self.scroll_to(top, left)
+        self.table[focus_y - self.top][focus_x - self.left].focus_set()
 
     def save(self, filename):
-        with open(filename, 'w') as file:
-            file.write('\n'.join(['\t'.join([element.get() for element in row]) for row in self.table]))
+        """Saves cells to .tab text file or to .npz file with typed columns and self.units"""
+        from prac_code.tableio import write_cells
+        self.store_visible()
+        write_cells(filename, self.data, units=self.units if filename.endswith('.npz') else None)
 
     def load_table(self, new_table):
-        new_rownum = len(new_table)
-        new_colnum = len(new_table[0]) if new_rownum != 0 else 0
-        self.change_size(new_colnum, new_rownum)
-        for y in range(self.rownum):
-            for x in range(self.colnum):
-                self.table[y][x].delete(0, tk.END)
-                self.table[y][x].insert(0, new_table[y][x])
+        """:param new_table: list of rows or 2d array of cells"""
+        if isinstance(new_table, np.ndarray) and new_table.ndim == 2:
+            data = new_table.astype(str).astype(object)
+        else:
+            new_rownum = len(new_table)
+            new_colnum = max((len(row) for row in new_table), default=0)
+            data = np.full((new_rownum, new_colnum), "", dtype=object)
+            for y, row in enumerate(new_table):
+                data[y, :len(row)] = [str(s) for s in row]
+        self.data = data
+        self.top = self.left = 0
+        self.show()
 
     def load(self, filename):
-        try:
-            with open(filename, 'r') as file:
-                new_table = [s.replace('\n', '').split('\t') for s in file]
-                self.load_table(new_table)
+        """Loads .tab or .npz file, OSError or ValueError is raised if it can not be read"""
+        from prac_code.tableio import read_cells
+        cells, units = read_cells(filename)
+        self.load_table(cells)
+        self.units = units
 
-        except Exception:
-            pass
+    def report_errors(self, func, *args):
+        """Calls func(*args) and shows message box instead of raising OSError or ValueError"""
+        try:
+            func(*args)
+        except (OSError, ValueError) as e:
+            from tkinter import messagebox
+            messagebox.showerror("error", str(e), parent=self)
 
     def add_col(self, number):
         if number > self.colnum or number < 0:
             return
-        self.remove_everything()
-        for y in range(self.rownum):
-            entry = tk.Entry(self)
-            row = self.table[y]
-            self.entry_bind(row, entry)
-            row.insert(number, entry)
-        self.collabels.append(tk.Label(self, text='{}'.format(self.colnum)))
-        self.colnum += 1
-        self.grid_everything()
+        self.store_visible()
+        self.data = np.insert(self.data, number, "", axis=1)
+        self.show()
 
     def del_col(self, number):
         if number >= self.colnum or number < 0:
             return
-        self.remove_everything()
-        for y in range(self.rownum):
-            self.table[y].pop(number)
-        self.colnum -= 1
-        self.collabels[-1].destroy()
-        self.collabels.pop()
-        self.grid_everything()
+        self.store_visible()
+        self.data = np.delete(self.data, number, axis=1)
+        self.show()
 
     def add_row(self, number):
         if number > self.rownum or number < 0:
             return
-        self.remove_everything()
-        new_row = []
-        for x in range(self.colnum):
-            entry = tk.Entry(self)
-            self.entry_bind(new_row, entry)
-            new_row.append(entry)
-        self.table.insert(number, new_row)
-        self.rowlabels.append(tk.Label(self, text='{}'.format(self.rownum)))
-        self.rownum += 1
-        self.grid_everything()
+        self.store_visible()
+        self.data = np.insert(self.data, number, "", axis=0)
+        self.show()
 
     def del_row(self, number):
         if number >= self.rownum or number < 0:
             return
-        self.remove_everything()
-        self.table.pop(number)
-        self.rownum -= 1
-        self.rowlabels[-1].destroy()
-        self.rowlabels.pop()
-        self.grid_everything()
+        self.store_visible()
+        self.data = np.delete(self.data, number, axis=0)
+        self.show()
 
     def make_modal(self, func, label_text, button_text):
         modal = ModalWindow(self, func, label_text, button_text)
@@ -136,62 +231,29 @@ class Table(tk.Frame):
         modal.focus_set()
         modal.wait_window()
 
-    def remove_everything(self):
-        for row in self.table:
-            for el in row:
-                el.grid_remove()
-        self.add_col_button.grid_remove()
-        self.add_row_button.grid_remove()
-        self.del_col_button.grid_remove()
-        self.del_row_button.grid_remove()
-        self.save_button.grid_remove()
-        self.load_button.grid_remove()
-
     def grid_everything(self):
-        for y in range(len(self.table)):
-            self.rowlabels[y].grid(row=y + 1, column=0)
-            if y == 0:
-                for x in range(len(self.table[0])):
-                    self.collabels[x].grid(row=0, column=x + 1)
-
-            for x in range(len(self.table[y])):
-                self.table[y][x].grid(row=y + 1, column=x + 1)
-        self.add_col_button.grid(row=len(self.table) + 1, column=1)
-        self.add_row_button.grid(row=len(self.table) + 1, column=2)
-        self.del_col_button.grid(row=len(self.table) + 2, column=1)
-        self.del_row_button.grid(row=len(self.table) + 2, column=2)
-        self.save_button.grid(row=len(self.table) + 1, column=3)
-        self.load_button.grid(row=len(self.table) + 2, column=3)
-
-    def entry_bind(self, row, entry):
-        entry.bind(
-            "<Control-Down>",
-            (lambda rw, en: lambda event: self.change_focus((rw, en), (0, 1)))(row, entry))
-        entry.bind(
-            "<Control-Up>",
-            (lambda rw, en: lambda event: self.change_focus((rw, en), (0, -1)))(row, entry))
-        entry.bind(
-            "<Control-Left>",
-            (lambda rw, en: lambda event: self.change_focus((rw, en), (-1, 0)))(row, entry))
-        entry.bind(
-            "<Control-Right>",
-            (lambda rw, en: lambda event: self.change_focus((rw, en), (1, 0)))(row, entry))
+        """Places scrollbars and buttons under window of cells"""
+        self.yscroll.grid(row=1, column=Table.VISIBLE_COLS + 1, rowspan=Table.VISIBLE_ROWS, sticky='ns')
+        self.xscroll.grid(row=Table.VISIBLE_ROWS + 1, column=1, columnspan=Table.VISIBLE_COLS, sticky='ew')
+        self.add_col_button.grid(row=Table.VISIBLE_ROWS + 2, column=1)
+        self.add_row_button.grid(row=Table.VISIBLE_ROWS + 2, column=2)
+        self.del_col_button.grid(row=Table.VISIBLE_ROWS + 3, column=1)
+        self.del_row_button.grid(row=Table.VISIBLE_ROWS + 3, column=2)
+        self.save_button.grid(row=Table.VISIBLE_ROWS + 2, column=3)
+        self.load_button.grid(row=Table.VISIBLE_ROWS + 3, column=3)
+
+    def entry_bind(self, y, x, entry):
+        entry.bind("<Control-Down>", lambda event: self.change_focus((y, x), (0, 1)))
+        entry.bind("<Control-Up>", lambda event: self.change_focus((y, x), (0, -1)))
+        entry.bind("<Control-Left>", lambda event: self.change_focus((y, x), (-1, 0)))
+        entry.bind("<Control-Right>", lambda event: self.change_focus((y, x), (1, 0)))
+        entry.bind("<MouseWheel>", lambda event: self.yview('scroll', -1 if event.delta > 0 else 1, 'units'))
+        entry.bind("<Button-4>", lambda event: self.yview('scroll', -1, 'units'))
+        entry.bind("<Button-5>", lambda event: self.yview('scroll', 1, 'units'))
 
     def create_widgets(self):
-        self.table = []
-        for x in range(self.colnum):
-            self.collabels.append(tk.Label(self, text='{}'.format(x)))
-
-        for y in range(self.rownum):
-            self.rowlabels.append(tk.Label(self, text='{}'.format(y)))
-
-        for y in range(self.rownum):
-            row = []
-            for x in range(self.colnum):
-                entry = tk.Entry(self)
-                self.entry_bind(row, entry)
-                row.append(entry)
-            self.table.append(row)
+        self.yscroll = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.xscroll = tk.Scrollbar(self, orient=tk.HORIZONTAL, command=self.xview)
         self.add_col_button = tk.Button(self, text="add column",
                                         command=lambda: self.make_modal(lambda s: self.add_col(int(s)),
                                                                         "number", "add"))
@@ -205,12 +267,13 @@ class Table(tk.Frame):
                                         command=lambda: self.make_modal(lambda s: self.del_row(int(s)),
                                                                         "number", "delete"))
         self.save_button = tk.Button(self, text="save",
-                                     command=lambda: self.make_modal(lambda s: self.save(s),
+                                     command=lambda: self.make_modal(lambda s: self.report_errors(self.save, s),
                                                                      "name", "save"))
         self.load_button = tk.Button(self, text="load",
-                                     command=lambda: self.make_modal(lambda s: self.load(s),
+                                     command=lambda: self.make_modal(lambda s: self.report_errors(self.load, s),
                                                                      "name", "load"))
         self.grid_everything()
+        self.show()
 
 
 def start(table=None):
@@ -1,23 +1,33 @@
 """
 Value module
 
-Contains Value class that can be used to calculate errors and value_operator_decorator to write methods
+Contains Value class that can be used to calculate errors, ValueArray class for whole columns of values
+and value_operator_decorator to write methods
 """
 from prac_code.praclib import get_pair
-from prac_code.praclib import get_deviation
 from prac_code.praclib import print_with_deviation
 from prac_code.praclib import rounding
-from prac_code.praclib import dict_adding
+from prac_code.praclib import get_numeric_deviation
+from prac_code.praclib import get_numeric_function
+from prac_code.praclib import get_compiled
+from prac_code.profiling import stage
 
-from sympy import Symbol
+from heapq import heappush, heappop
+from math import log
+from operator import add, sub, mul, truediv, neg, pos, pow
+from functools import partial
 from copy import deepcopy
+from collections import namedtuple
+from contextlib import contextmanager
+from weakref import WeakValueDictionary
 
-from scipy.stats import tstd
 import numpy as np
 
 
 def value_operator_decorator(operator):
     def custom_operator(first, second):
+        if isinstance(second, (ValueArray, np.ndarray)):
+            return NotImplemented
         if type(second) is float or type(second) is int:
             return operator(first, Value(const=second))
         return operator(first, second)
@@ -25,17 +35,166 @@ def value_operator_decorator(operator):
     return custom_operator
 
 
+MonteCarloResult = namedtuple("MonteCarloResult", [
+    "mean", "std", "percentiles", "valid"
+])
+
+GraphSize = namedtuple("GraphSize", [
+    "nodes", "symbols", "depth"
+])
+
+
+def _graph_size(value, *args, **kwargs):
+    """:return sizes of expression of value for profiling stages"""
+    return value.get_graph_size()._asdict()
+
+
+def _sum(*args):
+    return sum(args)
+
+
+def _mean(*args):
+    return sum(args) / len(args)
+
+
+def _weighted_mean(weights, *args):
+    return sum(w * a for w, a in zip(weights, args)) / sum(weights)
+
+
+_ARRAY_OPERATORS = {add, sub, mul, truediv, neg, pos, pow, _sum, _mean}
+
+_PENDING = object()
+
+# (value, partial derivatives) of operators by values of operands
+_RULES = {
+    add: lambda a, b: (a + b, (1.0, 1.0)),
+    sub: lambda a, b: (a - b, (1.0, -1.0)),
+    mul: lambda a, b: (a * b, (b, a)),
+    truediv: lambda a, b: (a / b, (1.0 / b, -a / b ** 2)),
+    neg: lambda a: (-a, (-1.0,)),
+    pos: lambda a: (a, (1.0,)),
+}
+
+
+def _linear_combination(value, coefficients, *args):
+    return value + sum(c * a for c, a in zip(coefficients, args))
+
+
+def _array_operator(op):
+    """:return function that applies op to numpy arrays"""
+    if op in _ARRAY_OPERATORS or isinstance(op, partial):
+        return op
+    return get_numeric_function(op)[0]
+
+
+class _SymbolPool:
+    """
+    Pool of symbols xi_0, xi_1, ... for independent Values.
+    Symbols are interned and created only when formula is needed, the number of symbol goes back
+    to the pool when the leaf that took it is freed, so long-running kernels use as many symbols as there are
+    alive independent Values. Names of the pool are reserved, named Values can't take them.
+    """
+
+    def __init__(self, prefix):
+        self.__prefix = prefix
+        self.__symbols = {}
+        self.__size = 0
+        self.__free = []
+
+    def take(self):
+        """:return number of symbol"""
+        if self.__free:
+            return heappop(self.__free)
+        self.__size += 1
+        return self.__size - 1
+
+    def get_symbol(self, number):
+        if number not in self.__symbols:
+            from sympy import Symbol
+            self.__symbols[number] = Symbol("{}{}".format(self.__prefix, number))
+        return self.__symbols[number]
+
+    def release(self, number):
+        heappush(self.__free, number)
+
+    def is_reserved(self, name):
+        """:return True if name is name of symbol of the pool"""
+        name = str(name)
+        return name.startswith(self.__prefix) and name[len(self.__prefix):].isdigit()
+
+    def __len__(self):
+        return self.__size - len(self.__free)
+
+
+class _Leaf:
+    """
+    Record of independent symbol, it is shared by all Values that are calculated from it.
+    Leaves are immutable, so copies of them are the same leaf and unpickled leaf takes new number from the pool,
+    only the leaf that took the number gives it back.
+    """
+    __slots__ = ('__symbol', 'value', 'deviation', 'ignored', 'number')
+
+    POOL = _SymbolPool("xi_")
+
+    def __init__(self, symbol, value, deviation, ignored):
+        """symbol -- sympy symbol or None to take symbol from the pool"""
+        self.number = None
+        if symbol is None:
+            self.number = _Leaf.POOL.take()
+        self.__symbol = symbol
+        self.value = value
+        self.deviation = deviation
+        self.ignored = ignored
+
+    @property
+    def symbol(self):
+        if self.__symbol is None:
+            self.__symbol = _Leaf.POOL.get_symbol(self.number)
+        return self.__symbol
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return _Leaf, (None if self.number is not None else self.__symbol, self.value, self.deviation, self.ignored)
+
+    def __del__(self):
+        if self.number is not None:
+            self.POOL.release(self.number)
+
+
 class Value:
     """
     Value class
 
-    Use it for calculations with values that has errors
+    Use it for calculations with values that has errors.
+    Operators only record nodes of expression graph: operation and links to the Values it is calculated from.
+    Equal operations with the same operands share one node. Values and partial derivatives of nodes
+    are calculated once when they are needed, errors are accumulated in one reverse pass over the graph,
+    symbols and sympy expression are collected on demand.
     """
 
-    __count = 0
+    __slots__ = (
+        '__value', '__leaf', '__op', '__parents', '__partials', '__symbol', '__has_error', '__grad', '__weakref__'
+    )
+
+    __nodes = WeakValueDictionary()
 
     NumberOfDigit = 10
 
+    class Method:
+        LINEAR = "linear"
+        MONTE_CARLO = "monte_carlo"
+
+    METHOD = Method.LINEAR
+    MC_SAMPLES = 100000
+    MC_CHUNK = 10000
+    MC_SEED = None
+    MC_PERCENTILES = (2.5, 50.0, 97.5)
+
     def __init__(self, *args, **kwargs):
         """
         :param kwargs:
@@ -44,115 +203,390 @@ class Value:
         ignorest -- set of symbols that are not used to calculate error
         """
         if len(args) == 1:
-            val = deepcopy(args[0])
-            self.__symbol = Symbol("const{}".format(Value.__count))
-            Value.__count += 1
-            self.__dct = {self.__symbol: get_pair(value=val, deviation=0.0)}
-            self.__ignoreset = {self.__symbol}
+            self.__create_const(deepcopy(args[0]))
         elif "dict" in kwargs and "symbol" in kwargs and "ignoreset" in kwargs:
             self.__create_from_formula(kwargs["dict"], kwargs["symbol"], kwargs["ignoreset"])
         elif "values" in kwargs and "syst" in kwargs:
-            if "name" in kwargs:
-                name = kwargs["name"]
-            else:
-                name = "c{}".format(Value.__count)
-                Value.__count += 1
+            name = kwargs["name"] if "name" in kwargs else None
             self.__create_new_symbol(name, kwargs["values"], kwargs["syst"])
         elif "const" in kwargs:
-            val = deepcopy(kwargs["const"])
-            self.__symbol = Symbol("const{}".format(Value.__count))
-            Value.__count += 1
-            self.__dct = {self.__symbol: get_pair(value=val, deviation=0.0)}
-            self.__ignoreset = {self.__symbol}
+            self.__create_const(deepcopy(kwargs["const"]))
         elif len(args) == 2:
-            name = "c{}".format(Value.__count)
-            Value.__count += 1
-            self.__create_new_symbol(name, [args[0]], args[1])
+            self.__create_new_symbol(None, [args[0]], args[1])
         else:
             raise ValueError(
                 "incorrect **args: there must be dict, symbol and ignoreset or values and syst or const"
             )
 
+    def __set_node(self, value, leaf, op, parents, partials, symbol):
+        self.__value = value
+        self.__leaf = leaf
+        self.__op = op
+        self.__parents = parents
+        self.__partials = partials
+        self.__symbol = symbol
+        self.__has_error = (not leaf.ignored) if leaf is not None else any(p.__has_error for p in parents)
+        self.__grad = None
+
+    @staticmethod
+    def __node_key(node):
+        """:return key of operand: constants are compared by value, other Values by identity"""
+        if node.__leaf is None and not node.__parents and node.__symbol is None:
+            return type(node.__value), node.__value
+        return id(node)
+
+    @staticmethod
+    def __node(op, parents, value=_PENDING, partials=None):
+        """
+        :return node of op applied to parents, its value and partials are calculated lazily if they are not given,
+        partials of linear operations can be given without value,
+        lazy node is shared with existing node of the same operation with the same operands
+        """
+        key = None
+        if value is _PENDING:
+            try:
+                key = (op,) + tuple(Value.__node_key(p) for p in parents)
+                res = Value.__nodes.get(key)
+                if res is not None:
+                    return res
+            except TypeError:
+                key = None
+        res = Value.__new__(Value)
+        res.__set_node(value, None, op, parents, partials, None)
+        if key is not None:
+            Value.__nodes[key] = res
+        return res
+
+    def __compute(self):
+        """Calculates value and partial derivatives of node from values of its parents"""
+        args = [p.__value for p in self.__parents]
+        if self.__partials is not None:
+            # partial derivatives of linear nodes do not depend on values
+            self.__value = self.__op(*args)
+        elif self.__op in _RULES:
+            self.__value, self.__partials = _RULES[self.__op](*args)
+        elif self.__op is pow:
+            base, exponent = self.__parents
+            val = args[0] ** args[1]
+            # derivatives are taken only when they are needed: base or exponent may be out of their domain
+            d_base = args[1] * args[0] ** (args[1] - 1) if base.__has_error else 0.0
+            d_exponent = val * log(args[0]) if exponent.__has_error else 0.0
+            self.__value, self.__partials = val, (d_base, d_exponent)
+        else:
+            f, df = get_numeric_function(self.__op)
+            self.__value, self.__partials = f(args[0]), (df(args[0]),)
+
+    def __get_value(self):
+        """:return value of self, values of pending nodes of graph are calculated once"""
+        if self.__value is _PENDING:
+            for node in self.__topological_order(pending=True):
+                node.__compute()
+        return self.__value
+
+    @staticmethod
+    def __leaf_value(leaf):
+        res = Value.__new__(Value)
+        res.__set_node(leaf.value, leaf, None, (), (), None)
+        return res
+
+    def __create_const(self, val):
+        # constants are not symbols, they are folded into expression as numbers
+        self.__set_node(val, None, None, (), (), None)
+
     def __create_from_formula(self, dct, symb, ignore):
-        self.__dct = dct
-        self.__symbol = symb
-        self.__ignoreset = ignore
+        from sympy import diff
+        Value.__check_names(dct)
+        vls = dict((s, dct[s][0]) for s in dct)
+        parents = tuple(Value.__leaf_value(_Leaf(s, dct[s][0], dct[s][1], s in ignore)) for s in dct)
+        partials = tuple(0.0 if s in ignore else float(diff(symb, s).subs(vls)) for s in dct)
+        self.__set_node(float(symb.subs(vls)), None, None, parents, partials, symb)
+
+    @staticmethod
+    def __check_names(names):
+        for name in names:
+            if _Leaf.POOL.is_reserved(name):
+                raise ValueError("name {} is reserved for Values without name".format(name))
 
     def __create_new_symbol(self, name, values, syst):
+        if name is not None:
+            Value.__check_names([name])
         try:
-            self.__symbol = Symbol(name)
-            self.__ignoreset = set()
+            if name is not None:
+                from sympy import Symbol
+                symbol = Symbol(name)
+            else:
+                symbol = None
             if len(values) >= 3:
+                from scipy.stats import tstd
                 val, er = np.array(values).mean(), tstd(values)
             else:
                 val, er = values[0], 0.0
-            er = (er ** 2 + syst ** 2) ** 0.5
-            self.__dct = {self.__symbol: get_pair(value=val, deviation=er)}  # added systematic(?) deviation
+            er = (er ** 2 + syst ** 2) ** 0.5  # added systematic(?) deviation
+            self.__set_node(val, _Leaf(symbol, val, er, False), None, (), (), None)
         except Exception:
             raise ValueError("incorrect name or values or error")
 
+    def __topological_order(self, pending=False):
+        """
+        :param pending: True to collect only nodes with values that are not calculated yet
+        :return list of all Values that self is calculated from, every Value goes after its parents
+        """
+        order = []
+        visited = set()
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif id(node) not in visited:
+                visited.add(id(node))
+                stack.append((node, True))
+                stack.extend(
+                    (p, False) for p in reversed(node.__parents)
+                    if id(p) not in visited and (not pending or p.__value is _PENDING)
+                )
+        return order
+
+    def __get_formula(self):
+        """:return (symbol, dict {symbol: (value, error)}, ignoreset) that describe self"""
+        from sympy import sympify
+        exprs = {}
+        dct = {}
+        ignoreset = set()
+        for node in self.__topological_order():
+            if node.__symbol is not None:
+                exprs[id(node)] = node.__symbol
+            elif node.__leaf is not None:
+                leaf = node.__leaf
+                exprs[id(node)] = leaf.symbol
+                dct[leaf.symbol] = get_pair(value=leaf.value, deviation=leaf.deviation)
+                if leaf.ignored:
+                    ignoreset.add(leaf.symbol)
+            elif not node.__parents:
+                exprs[id(node)] = sympify(node.__value)
+            else:
+                exprs[id(node)] = node.__op(*[exprs[id(p)] for p in node.__parents])
+        return exprs[id(self)], dct, ignoreset
+
+    def __get_grad(self):
+        """
+        :return dict {leaf: partial derivative}, it is accumulated in one reverse pass,
+        so every node of graph is visited once whatever number of independent Values is
+        """
+        if self.__grad is None:
+            self.__get_value()
+            order = self.__topological_order()
+            adjoints = {id(self): 1.0}
+            grad = {}
+            for node in reversed(order):
+                adjoint = adjoints.pop(id(node), 0.0)
+                if node.__leaf is not None:
+                    if not node.__leaf.ignored:
+                        grad[node.__leaf] = grad.get(node.__leaf, 0.0) + adjoint
+                    continue
+                for p, derivative in zip(node.__parents, node.__partials):
+                    if p.__has_error:
+                        adjoints[id(p)] = adjoints.get(id(p), 0.0) + adjoint * derivative
+            # leaves go in order of their first appearance in expression
+            self.__grad = dict((node.__leaf, grad[node.__leaf]) for node in order if node.__leaf in grad)
+        return self.__grad
+
+    @staticmethod
+    def correlated(values, cov):
+        """
+        :param values: list of values
+        :param cov: their covariance matrix
+        :return list of Values with covariance matrix cov, they depend on shared independent unit errors
+        """
+        values = np.asarray(values, dtype=float)
+        eigenvalues, eigenvectors = np.linalg.eigh(np.asarray(cov, dtype=float))
+        transform = eigenvectors * np.sqrt(np.clip(eigenvalues, 0.0, None))
+        sources = tuple(Value(0.0, 1.0) for _ in range(len(values)))
+        coefficients = [tuple(float(c) for c in row) for row in transform]
+        return [
+            Value.__node(
+                partial(_linear_combination, float(values[j]), coefficients[j]), sources,
+                float(values[j]), coefficients[j]
+            )
+            for j in range(len(values))
+        ]
+
+    @staticmethod
+    def __aggregate(op, values, partials):
+        values = tuple(v if isinstance(v, Value) else Value(const=v) for v in values)
+        if not values:
+            raise ValueError("there are no values to aggregate")
+        return Value.__node(op, values, partials=tuple(partials))
+
+    @staticmethod
+    def sum(values):
+        """:return sum of Values as one node, its error is accumulated in time linear in number of values"""
+        values = list(values)
+        return Value.__aggregate(_sum, values, [1.0] * len(values))
+
+    @staticmethod
+    def mean(values):
+        """:return arithmetic mean of Values as one node"""
+        values = list(values)
+        return Value.__aggregate(_mean, values, [1.0 / len(values)] * len(values) if values else [])
+
+    @staticmethod
+    def weighted_mean(values, weights=None):
+        """
+        :param weights: weights of values, inverse squared errors of values by default
+        :return weighted mean of Values as one node, weights are constants,
+        ValueError is raised if default weights are used and some value has zero error
+        """
+        values = [v if isinstance(v, Value) else Value(const=v) for v in values]
+        if weights is None:
+            errors = [float(v.get_value_error(rounded=False)[1]) for v in values]
+            if not all(er > 0 for er in errors):
+                raise ValueError("values with zero errors have infinite weights, weights must be given")
+            weights = [1.0 / er ** 2 for er in errors]
+        weights = tuple(float(w) for w in weights)
+        total = sum(weights)
+        return Value.__aggregate(partial(_weighted_mean, weights), values, [w / total for w in weights])
+
+    @stage("value.print_value_error", _graph_size)
     def print_value_error(self, **kwargs):
         """:return string with Tex code"""
         notebook = True
         ignore = set()
         if "notebook" in kwargs:
             notebook = kwargs["notebook"]
+        symbol, dct, ignoreset = self.__get_formula()
         if "ignore" in kwargs:
-            ignore = {v.__symbol for v in kwargs["ignore"]}
+            ignore = set().union(*[v.__get_formula()[1] for v in kwargs["ignore"]])
 
-        return print_with_deviation(self.__symbol, self.__dct, self.__ignoreset | ignore, notebook)
+        return print_with_deviation(symbol, dct, ignoreset | ignore, notebook)
 
-    def get_value_error(self):
-        """:return (value, error) tuple that are rounded by praclib.rounding"""
-        er = get_deviation(self.__symbol, self.__dct, self.__ignoreset)[2]
-        vls = dict((s, self.__dct[s][0]) for s in self.__dct)
-        return rounding(float(self.__symbol.subs(vls)), float(er))
+    @staticmethod
+    @contextmanager
+    def use_method(method):
+        """Context manager that switches Value.METHOD, for example to Value.Method.MONTE_CARLO"""
+        old = Value.METHOD
+        Value.METHOD = method
+        try:
+            yield
+        finally:
+            Value.METHOD = old
+
+    def __sample(self, rng, size):
+        """:return array of size samples of self, independent Values are normally distributed"""
+        order = self.__topological_order()
+        consumers = {}
+        for node in order:
+            for p in node.__parents:
+                consumers[id(p)] = consumers.get(id(p), 0) + 1
+        samples = {}
+        for node in order:
+            if node.__leaf is not None and not node.__leaf.ignored:
+                res = rng.normal(float(node.__value), float(node.__leaf.deviation), size)
+            elif not node.__parents:
+                res = float(node.__value)
+            elif node.__symbol is not None:
+                symbols = tuple(p.__leaf.symbol for p in node.__parents)
+                res = get_compiled(node.__symbol, symbols)(*[samples[id(p)] for p in node.__parents])
+            else:
+                res = _array_operator(node.__op)(*[samples[id(p)] for p in node.__parents])
+            for p in node.__parents:
+                consumers[id(p)] -= 1
+                if consumers[id(p)] == 0:
+                    del samples[id(p)]
+            samples[id(node)] = res
+        return np.broadcast_to(samples[id(self)], (size,))
+
+    @stage("value.monte_carlo", _graph_size)
+    def monte_carlo(self, **kwargs):
+        """
+        Propagates errors by evaluating expression once for whole arrays of samples of independent Values.
+        Samples are generated in chunks, so only results of samples are kept in memory.
+        :param kwargs: samples, chunk, seed, percentiles (Value.MC_* by default)
+        :return MonteCarloResult(mean, std, percentiles, valid) where percentiles is dict {percentile: value},
+        valid is fraction of samples where expression is finite, statistics are calculated only for them
+        """
+        samples = kwargs['samples'] if 'samples' in kwargs else Value.MC_SAMPLES
+        chunk = kwargs['chunk'] if 'chunk' in kwargs else Value.MC_CHUNK
+        rng = np.random.default_rng(kwargs['seed'] if 'seed' in kwargs else Value.MC_SEED)
+        percentiles = kwargs['percentiles'] if 'percentiles' in kwargs else Value.MC_PERCENTILES
+        res = np.empty(samples)
+        with np.errstate(all='ignore'):
+            for start in range(0, samples, chunk):
+                size = min(chunk, samples - start)
+                res[start:start + size] = self.__sample(rng, size)
+        finite = res[np.isfinite(res)]
+        if finite.size < 2:
+            raise ValueError("expression is not finite for samples of its Values")
+        return MonteCarloResult(
+            finite.mean(), finite.std(ddof=1),
+            dict(zip(percentiles, np.percentile(finite, percentiles))), finite.size / samples
+        )
+
+    @stage("value.get_value_error", _graph_size)
+    def get_value_error(self, **kwargs):
+        """
+        :param kwargs: method (Value.METHOD by default), Value.Method.MONTE_CARLO takes value and error
+        as mean and standard deviation of Value.monte_carlo(),
+        rounded (True by default), False returns floats that are not rounded
+        :return (value, error) tuple that are rounded by praclib.rounding
+        """
+        method = kwargs['method'] if 'method' in kwargs else Value.METHOD
+        rounded = kwargs['rounded'] if 'rounded' in kwargs else True
+        if method == Value.Method.MONTE_CARLO:
+            res = self.monte_carlo()
+            val, er = float(res.mean), float(res.std)
+        else:
+            grad = self.__get_grad()
+            val = float(self.__get_value())
+            er = float(get_numeric_deviation((grad[leaf], leaf.deviation) for leaf in grad))
+        return rounding(val, er) if rounded else (val, er)
+
+    def get_graph_size(self):
+        """:return GraphSize(nodes, symbols, depth) of expression graph, symbols are independent Values"""
+        order = self.__topological_order()
+        depth = {}
+        for node in order:
+            depth[id(node)] = 1 + max((depth[id(p)] for p in node.__parents), default=-1)
+        return GraphSize(len(order), sum(1 for node in order if node.__leaf is not None), depth[id(self)])
+
+    def get_gradient(self):
+        """:return (value, {source: (partial derivative, error)}) tuple that is not rounded"""
+        grad = self.__get_grad()
+        return self.__get_value(), dict((leaf, (grad[leaf], leaf.deviation)) for leaf in grad)
 
     @value_operator_decorator
     def __add__(self, other):
-        return Value(
-            symbol=self.__symbol + other.__symbol, dict=dict_adding(self.__dct, other.__dct),
-            ignoreset=self.__ignoreset | other.__ignoreset
-        )
+        return Value.__node(add, (self, other))
 
     def __radd__(self, other):
         return Value(const=other) + self
 
     @value_operator_decorator
     def __sub__(self, other):
-        return Value(
-            symbol=self.__symbol - other.__symbol, dict=dict_adding(self.__dct, other.__dct),
-            ignoreset=self.__ignoreset | other.__ignoreset
-        )
+        return Value.__node(sub, (self, other))
 
     def __rsub__(self, other):
         return Value(const=other) - self
 
     @value_operator_decorator
     def __mul__(self, other):
-        return Value(
-            symbol=self.__symbol * other.__symbol, dict=dict_adding(self.__dct, other.__dct),
-            ignoreset=self.__ignoreset | other.__ignoreset
-        )
+        return Value.__node(mul, (self, other))
 
     def __rmul__(self, other):
         return Value(const=other) * self
 
     @value_operator_decorator
     def __truediv__(self, other):
-        return Value(
-            symbol=self.__symbol / other.__symbol, dict=dict_adding(self.__dct, other.__dct),
-            ignoreset=self.__ignoreset | other.__ignoreset
-        )
+        return Value.__node(truediv, (self, other))
 
     def __rtruediv__(self, other):
         return Value(const=other) / self
 
     def __neg__(self):
-        return Value(symbol=-self.__symbol, dict=self.__dct, ignoreset=self.__ignoreset)
+        return Value.__node(neg, (self,))
 
     def __pos__(self):
-        return Value(symbol=self.__symbol, dict=self.__dct, ignoreset=self.__ignoreset)
+        return Value.__node(pos, (self,))
 
     def __str__(self):
         val, er = self.get_value_error()
@@ -161,10 +595,7 @@ class Value:
 
     @value_operator_decorator
     def __pow__(self, other):
-        return Value(
-            symbol=self.__symbol ** other.__symbol, dict=dict_adding(self.__dct, other.__dct),
-            ignoreset=self.__ignoreset | other.__ignoreset
-        )
+        return Value.__node(pow, (self, other))
 
     def __rpow__(self, other):
         return Value(const=other) ** self
@@ -200,7 +631,7 @@ class Value:
 
     def use_func(self, func):
         """:return Value object with symbol equal to func(self.__symbol)"""
-        return Value(symbol=func(self.__symbol), dict=self.__dct, ignoreset=self.__ignoreset)
+        return Value.__node(func, (self,))
 
 
 def create_error(errorsize, like_array=None):
@@ -211,3 +642,434 @@ def create_error(errorsize, like_array=None):
         )
     else:
         return Value(0, errorsize)
+
+
+def _repeat_errors(count, std, syst, confidence):
+    """
+    :param count, std: arrays of numbers of repeats and their sample standard deviations
+    :param confidence: None to take std as random error like Value does,
+    or confidence level to take Student-t scaled error of mean
+    :return combined errors of means, random error is zero where there are less than 2 repeats
+    """
+    count = np.asarray(count, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if confidence is not None:
+            from scipy.stats import t as student
+            random = student.ppf(0.5 + confidence / 2.0, count - 1) * std / np.sqrt(count)
+        else:
+            random = std
+    random = np.where(count >= 2, random, 0.0)
+    return np.sqrt(random ** 2 + np.asarray(syst, dtype=float) ** 2)
+
+
+def _broadcast_rows(shape, new_shape):
+    """:return indices of rows of array with shape that are used in array broadcasted to new_shape"""
+    return np.broadcast_to(np.arange(int(np.prod(shape))).reshape(shape), new_shape).ravel()
+
+
+def _merge_sources(a, b):
+    """:return (sources, columns, width): sources of a extended by b, columns of b in them and their number"""
+    offsets = {}
+    width = 0
+    for key, sigma in a:
+        offsets[key] = width
+        width += sigma.size
+    res = list(a)
+    columns = []
+    for key, sigma in b:
+        if key not in offsets:
+            offsets[key] = width
+            width += sigma.size
+            res.append((key, sigma))
+        columns.append(np.arange(offsets[key], offsets[key] + sigma.size))
+    columns = np.concatenate(columns) if columns else np.zeros(0, dtype=int)
+    return tuple(res), columns, width
+
+
+class ValueArray:
+    """
+    ValueArray class
+
+    Use it instead of arrays of Value objects. Nominal values are stored in one ndarray and
+    sensitivities to independent errors are stored in a sparse jacobian with one row per element
+    and one column per error source.
+    """
+
+    UNARY_DERIVATIVES = {
+        np.negative: lambda x, y: -np.ones_like(x),
+        np.positive: lambda x, y: np.ones_like(x),
+        np.absolute: lambda x, y: np.sign(x),
+        np.square: lambda x, y: 2.0 * x,
+        np.sqrt: lambda x, y: 0.5 / y,
+        np.cbrt: lambda x, y: 1.0 / (3.0 * y ** 2),
+        np.reciprocal: lambda x, y: -y ** 2,
+        np.exp: lambda x, y: y,
+        np.exp2: lambda x, y: y * np.log(2.0),
+        np.expm1: lambda x, y: y + 1.0,
+        np.log: lambda x, y: 1.0 / x,
+        np.log2: lambda x, y: 1.0 / (x * np.log(2.0)),
+        np.log10: lambda x, y: 1.0 / (x * np.log(10.0)),
+        np.log1p: lambda x, y: 1.0 / (1.0 + x),
+        np.sin: lambda x, y: np.cos(x),
+        np.cos: lambda x, y: -np.sin(x),
+        np.tan: lambda x, y: 1.0 + y ** 2,
+        np.arcsin: lambda x, y: 1.0 / np.sqrt(1.0 - x ** 2),
+        np.arccos: lambda x, y: -1.0 / np.sqrt(1.0 - x ** 2),
+        np.arctan: lambda x, y: 1.0 / (1.0 + x ** 2),
+        np.sinh: lambda x, y: np.cosh(x),
+        np.cosh: lambda x, y: np.sinh(x),
+        np.tanh: lambda x, y: 1.0 - y ** 2,
+    }
+
+    BINARY_OPERATORS = {
+        np.add: "add",
+        np.subtract: "subtract",
+        np.multiply: "multiply",
+        np.true_divide: "divide",
+        np.power: "power",
+    }
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param args:
+        values -- array of values
+        errors -- independent error of every value, scalar or array (0.0 by default)
+        :param kwargs:
+        values, jacobian, sources -- values, sparse jacobian and tuple of (key, errors) pairs of error sources
+        """
+        from scipy import sparse
+        if "values" in kwargs and "jacobian" in kwargs and "sources" in kwargs:
+            self.__values = kwargs["values"]
+            self.__jacobian = kwargs["jacobian"]
+            self.__sources = kwargs["sources"]
+        elif 1 <= len(args) <= 2:
+            self.__values = np.array(args[0], dtype=float)
+            errors = np.broadcast_to(np.asarray(args[1] if len(args) == 2 else 0.0, dtype=float),
+                                     self.__values.shape).ravel()
+            if np.any(errors != 0.0):
+                self.__jacobian = sparse.identity(errors.size, format="csr")
+                self.__sources = ((object(), np.array(errors)),)
+            else:
+                self.__jacobian = sparse.csr_matrix((errors.size, 0))
+                self.__sources = ()
+        else:
+            raise ValueError("incorrect *args: there must be values and errors")
+
+    @staticmethod
+    def from_repeats(repeats, syst=0.0, **kwargs):
+        """
+        Makes ValueArray of means of repeated measurements in one vectorized call
+        :param repeats: array of readings, its last axis is repeats of one measurement, nan readings are skipped
+        :param syst: systematic error that is added to random error of every mean, scalar or array
+        :param kwargs: confidence -- None by default to take standard deviation of readings as random error
+        like Value(values=..., syst=...), or confidence level (for example 0.95) to take Student-t scaled
+        standard error of mean, axis -- axis of repeats (-1 by default)
+        :return ValueArray of means with independent combined errors
+        """
+        axis = kwargs['axis'] if 'axis' in kwargs else -1
+        confidence = kwargs['confidence'] if 'confidence' in kwargs else None
+        repeats = np.moveaxis(np.asarray(repeats, dtype=float), axis, -1)
+        count = np.sum(~np.isnan(repeats), axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(repeats, axis=-1) / count
+            std = np.sqrt(np.nansum((repeats - mean[..., np.newaxis]) ** 2, axis=-1) / (count - 1))
+        return ValueArray(mean, _repeat_errors(count, std, syst, confidence))
+
+    @staticmethod
+    def from_value(value):
+        """:return ValueArray with shape () that has the same value and error sources as Value object"""
+        from scipy import sparse
+        val, grad = value.get_gradient()
+        symbols = list(grad)
+        return ValueArray(
+            values=np.array(float(val)),
+            jacobian=sparse.csr_matrix(np.array([[float(grad[s][0]) for s in symbols]]).reshape(1, len(symbols))),
+            sources=tuple((s, np.array([float(grad[s][1])])) for s in symbols)
+        )
+
+    @staticmethod
+    def as_value_array(other):
+        if isinstance(other, ValueArray):
+            return other
+        if isinstance(other, Value):
+            return ValueArray.from_value(other)
+        return ValueArray(other)
+
+    @property
+    def values(self):
+        return self.__values
+
+    @property
+    def jacobian(self):
+        """:return sparse jacobian with one row per element and one column per error of sources"""
+        return self.__jacobian
+
+    @property
+    def sources(self):
+        """:return tuple of (key, errors) pairs of independent error sources"""
+        return self.__sources
+
+    @property
+    def errors(self):
+        sigma = np.concatenate([s for _, s in self.__sources]) if self.__sources else np.zeros(0)
+        squared = self.__jacobian.copy()
+        squared.data **= 2
+        return np.sqrt(squared @ sigma ** 2).reshape(self.__values.shape)
+
+    @property
+    def shape(self):
+        return self.__values.shape
+
+    @property
+    def ndim(self):
+        return self.__values.ndim
+
+    @property
+    def size(self):
+        return self.__values.size
+
+    def __len__(self):
+        return len(self.__values)
+
+    def get_value_error(self):
+        """:return (values, errors) tuple of arrays that are not rounded"""
+        return self.__values, self.errors
+
+    def __repr__(self):
+        return "ValueArray({}, {})".format(self.__values, self.errors)
+
+    def __getitem__(self, key):
+        rows = np.arange(self.size).reshape(self.shape)[key]
+        return ValueArray(
+            values=np.array(self.__values[key]),
+            jacobian=self.__jacobian[np.ravel(rows)],
+            sources=self.__sources
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __jacobian_like(self, shape, columns, width):
+        from scipy import sparse
+        jacobian = self.__jacobian
+        if self.shape != shape:
+            jacobian = jacobian[_broadcast_rows(self.shape, shape)]
+        jacobian = jacobian.tocsr()
+        return sparse.csr_matrix((jacobian.data, columns[jacobian.indices], jacobian.indptr),
+                                 shape=(jacobian.shape[0], width))
+
+    @staticmethod
+    def __apply(values, operands, derivatives):
+        """:return ValueArray with values and jacobian equal to sum of derivative * operand jacobian"""
+        from scipy import sparse
+        sources = ()
+        columns = []
+        width = 0
+        for operand in operands:
+            sources, new_columns, width = _merge_sources(sources, operand.__sources)
+            columns.append(new_columns)
+        jacobian = sparse.csr_matrix((values.size, width))
+        for operand, derivative, new_columns in zip(operands, derivatives, columns):
+            if operand.__jacobian.nnz == 0:
+                continue
+            part = operand.__jacobian_like(values.shape, new_columns, width)
+            jacobian = jacobian + sparse.diags(np.broadcast_to(derivative, values.shape).ravel()) @ part
+        return ValueArray(values=np.asarray(values, dtype=float), jacobian=jacobian.tocsr(), sources=sources)
+
+    def __aggregate(self, weights, axis):
+        """
+        :param weights: weights of elements, array that is broadcastable to shape
+        :return ValueArray of weighted sums over axis (all elements if axis is None)
+        """
+        from scipy import sparse
+        rows = np.arange(self.size).reshape(self.shape)
+        if axis is None:
+            groups = np.zeros(self.size, dtype=int)
+            shape = ()
+        else:
+            shape = np.delete(np.array(self.shape, dtype=int), axis)
+            groups = np.broadcast_to(
+                np.expand_dims(np.arange(int(np.prod(shape))).reshape(shape), axis), self.shape
+            ).ravel()
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), self.shape).ravel()
+        matrix = sparse.csr_matrix((weights, (groups, rows.ravel())), shape=(int(np.prod(shape)), self.size))
+        return ValueArray(
+            values=np.asarray(matrix @ self.__values.ravel()).reshape(tuple(shape)),
+            jacobian=(matrix @ self.__jacobian).tocsr(),
+            sources=self.__sources
+        )
+
+    def sum(self, axis=None):
+        """:return ValueArray of sums over axis, errors of sources are added with their correlations"""
+        return self.__aggregate(1.0, axis)
+
+    def mean(self, axis=None):
+        """:return ValueArray of arithmetic means over axis"""
+        count = self.size if axis is None else self.shape[axis]
+        return self.__aggregate(1.0 / count, axis)
+
+    def weighted_mean(self, weights=None, axis=None):
+        """
+        :param weights: array of weights that is broadcastable to shape, inverse squared errors by default
+        :return ValueArray of weighted means over axis, weights are constants,
+        ValueError is raised if default weights are used and some element has zero error
+        """
+        if weights is None:
+            errors = self.errors
+            if not np.all(errors > 0):
+                raise ValueError("values with zero errors have infinite weights, weights must be given")
+            weights = 1.0 / errors ** 2
+        else:
+            weights = np.broadcast_to(np.asarray(weights, dtype=float), self.shape)
+        total = weights.sum(axis=axis, keepdims=axis is not None)
+        return self.__aggregate(weights / total, axis)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != "__call__" or kwargs:
+            return NotImplemented
+        if len(inputs) == 1 and ufunc in ValueArray.UNARY_DERIVATIVES:
+            x = self.__values
+            y = ufunc(x)
+            return ValueArray.__apply(y, [self], [ValueArray.UNARY_DERIVATIVES[ufunc](x, y)])
+        if len(inputs) == 2 and ufunc in ValueArray.BINARY_OPERATORS:
+            operator = getattr(ValueArray, ValueArray.BINARY_OPERATORS[ufunc])
+            return operator(*map(ValueArray.as_value_array, inputs))
+        return NotImplemented
+
+    def __binary(self, other, values, d_self, d_other):
+        return ValueArray.__apply(values, [self, other], [d_self, d_other])
+
+    @staticmethod
+    def add(a, b):
+        return a.__binary(b, a.__values + b.__values, 1.0, 1.0)
+
+    @staticmethod
+    def subtract(a, b):
+        return a.__binary(b, a.__values - b.__values, 1.0, -1.0)
+
+    @staticmethod
+    def multiply(a, b):
+        return a.__binary(b, a.__values * b.__values, b.__values, a.__values)
+
+    @staticmethod
+    def divide(a, b):
+        return a.__binary(b, a.__values / b.__values, 1.0 / b.__values, -a.__values / b.__values ** 2)
+
+    @staticmethod
+    def power(a, b):
+        values = a.__values ** b.__values
+        # derivatives are taken only when they are needed: base or exponent may be out of their domain
+        d_a = b.__values * a.__values ** (b.__values - 1) if a.__jacobian.nnz else 0.0
+        d_b = values * np.log(a.__values) if b.__jacobian.nnz else 0.0
+        return a.__binary(b, values, d_a, d_b)
+
+    def __add__(self, other):
+        return ValueArray.add(self, ValueArray.as_value_array(other))
+
+    def __radd__(self, other):
+        return ValueArray.add(ValueArray.as_value_array(other), self)
+
+    def __sub__(self, other):
+        return ValueArray.subtract(self, ValueArray.as_value_array(other))
+
+    def __rsub__(self, other):
+        return ValueArray.subtract(ValueArray.as_value_array(other), self)
+
+    def __mul__(self, other):
+        return ValueArray.multiply(self, ValueArray.as_value_array(other))
+
+    def __rmul__(self, other):
+        return ValueArray.multiply(ValueArray.as_value_array(other), self)
+
+    def __truediv__(self, other):
+        return ValueArray.divide(self, ValueArray.as_value_array(other))
+
+    def __rtruediv__(self, other):
+        return ValueArray.divide(ValueArray.as_value_array(other), self)
+
+    def __pow__(self, other):
+        return ValueArray.power(self, ValueArray.as_value_array(other))
+
+    def __rpow__(self, other):
+        return ValueArray.power(ValueArray.as_value_array(other), self)
+
+    def use_func(self, func):
+        """:return ValueArray object with values equal to func(values), func is applicable to sympy symbols"""
+        f, df = get_numeric_function(func)
+        return ValueArray.__apply(np.asarray(f(self.__values), dtype=float), [self], [df(self.__values)])
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __pos__(self):
+        return np.positive(self)
+
+    def __abs__(self):
+        return np.absolute(self)
+
+
+class RepeatAccumulator:
+    """
+    RepeatAccumulator class
+
+    Accumulates repeated readings of many measurements as they arrive by Welford's algorithm,
+    so readings are not stored. Blocks of repeats are merged by Chan's formula.
+    """
+
+    def __init__(self, shape=()):
+        """:param shape: shape of array of measurements"""
+        self.__count = np.zeros(shape)
+        self.__mean = np.zeros(shape)
+        self.__m2 = np.zeros(shape)
+
+    def add(self, readings):
+        """
+        Adds one reading of every measurement, nan readings are skipped
+        :param readings: array with shape of measurements
+        """
+        readings = np.broadcast_to(np.asarray(readings, dtype=float), self.__mean.shape)
+        valid = ~np.isnan(readings)
+        count = self.__count + valid
+        delta = np.where(valid, readings - self.__mean, 0.0)
+        self.__mean = self.__mean + np.divide(delta, count, out=np.zeros_like(delta), where=count > 0)
+        self.__m2 = self.__m2 + delta * np.where(valid, readings - self.__mean, 0.0)
+        self.__count = count
+        return self
+
+    def add_block(self, repeats):
+        """
+        Adds block of repeats of every measurement, nan readings are skipped
+        :param repeats: array with shape of measurements and one more last axis of repeats
+        """
+        repeats = np.asarray(repeats, dtype=float)
+        count = np.sum(~np.isnan(repeats), axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.nansum(repeats, axis=-1) / count, 0.0)
+        m2 = np.nansum((repeats - mean[..., np.newaxis]) ** 2, axis=-1)
+        total = self.__count + count
+        delta = mean - self.__mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.__mean = np.where(total > 0, self.__mean + delta * count / total, 0.0)
+            self.__m2 = self.__m2 + m2 + np.where(total > 0, delta ** 2 * self.__count * count / total, 0.0)
+        self.__count = total
+        return self
+
+    @property
+    def count(self):
+        return self.__count
+
+    @property
+    def mean(self):
+        """:return means of readings, nan where there are no readings like in ValueArray.from_repeats"""
+        return np.where(self.__count > 0, self.__mean, np.nan)
+
+    @property
+    def std(self):
+        """:return sample standard deviations of readings, nan where there are less than 2 readings"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(np.where(self.__count >= 2, self.__m2 / (self.__count - 1), np.nan))
+
+    def get_value_array(self, syst=0.0, confidence=None):
+        """:return ValueArray of means with errors like ValueArray.from_repeats"""
+        return ValueArray(self.mean, _repeat_errors(self.__count, self.std, syst, confidence))